@@ -0,0 +1,446 @@
+import os
+import sys
+import time
+import math
+import collections
+import multiprocessing
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+import torch.utils.data
+import torchvision.transforms as transforms
+import torchvision.datasets as datasets
+from PIL import Image
+
+
+class MyScale(object):
+    def __init__(self, size, interpolation=Image.BILINEAR):
+        self.size = size
+        self.interpolation = interpolation
+
+    def __call__(self, img):
+        if isinstance(self.size, int):
+            w, h = img.size
+            if (w <= h and w == self.size) or (h <= w and h == self.size):
+                return img
+            if w < h:
+                ow = self.size
+                oh = int(self.size * h / w)
+                return img.resize((ow, oh), self.interpolation)
+            else:
+                oh = self.size
+                ow = int(self.size * w / h)
+                return img.resize((ow, oh), self.interpolation)
+        else:
+            return img.resize(self.size)#, self.interpolation)
+
+
+class DraftLoader(object):
+    """ImageFolder loader that lets the JPEG decoder downscale by 1/2, 1/4
+    or 1/8 in the DCT domain while the image stays at least size, so large
+    photos are never fully decoded only to be shrunk by MyScale. Other
+    formats decode at full size."""
+
+    def __init__(self, size=(256, 256)):
+        self.size = size
+
+    def __call__(self, path):
+        with open(path, 'rb') as f:
+            img = Image.open(f)
+            img.draft('RGB', self.size)
+            return img.convert('RGB')
+
+
+def build_image_cache(root, cache_dir, size=(256, 256), workers=4, loader=None):
+    """Decodes every image of the ImageFolder at root once, resizes it with
+    MyScale(size) and writes the results to cache_dir/images.npy, an
+    (N, H, W, 3) uint8 array, with the class indices in labels.npy.
+    images.npy only appears once the whole array is written."""
+    dataset = datasets.ImageFolder(root, transforms.Compose([
+        MyScale(size),
+        lambda img: np.asarray(img.convert('RGB')),
+    ]), loader=loader or DraftLoader(size))
+    loader = torch.utils.data.DataLoader(dataset, batch_size=64, num_workers=workers)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    partial = os.path.join(cache_dir, 'images.partial.npy')
+    images = np.lib.format.open_memmap(partial, mode='w+', dtype=np.uint8,
+                                       shape=(len(dataset), size[1], size[0], 3))
+    labels = np.empty(len(dataset), dtype=np.int64)
+    start = 0
+    for batch, target in loader:
+        images[start:start + len(batch)] = batch.numpy()
+        labels[start:start + len(batch)] = target.numpy()
+        start += len(batch)
+    images.flush()
+    del images
+    np.save(os.path.join(cache_dir, 'labels.npy'), labels)
+    os.rename(partial, os.path.join(cache_dir, 'images.npy'))
+
+
+class InfiniteSampler(torch.utils.data.Sampler):
+    """Indices of a dataset of n samples, forever, in a fresh random order
+    on every pass (or in order, if not shuffle)."""
+
+    def __init__(self, n, shuffle=True):
+        self.n = n
+        self.shuffle = shuffle
+
+    def __iter__(self):
+        while True:
+            order = torch.randperm(self.n) if self.shuffle else torch.arange(self.n)
+            for index in order.tolist():
+                yield index
+
+
+class PairedDataset(torch.utils.data.Dataset):
+    """Indexed by (source index, target index) pairs."""
+
+    def __init__(self, source, target):
+        self.source = source
+        self.target = target
+
+    def __getitem__(self, index):
+        return self.source[index[0]], self.target[index[1]]
+
+
+class PairedBatchSampler(torch.utils.data.Sampler):
+    """Endless batches of batch_size (source, target) index pairs, each
+    domain drawn from its own InfiniteSampler and so reshuffled on its own
+    cycle."""
+
+    def __init__(self, source_num, target_num, batch_size):
+        self.source = InfiniteSampler(source_num)
+        self.target = InfiniteSampler(target_num)
+        self.batch_size = batch_size
+
+    def __iter__(self):
+        source, target = iter(self.source), iter(self.target)
+        while True:
+            yield [(next(source), next(target)) for _ in range(self.batch_size)]
+
+
+def paired_collate(batch):
+    """Collates B (source, target) sample pairs into (inputs, source labels,
+    target labels), with inputs a single (2B, ...) tensor holding the source
+    samples then the target ones. In a worker the buffer is allocated in
+    shared memory, as default_collate does, so it reaches the main process
+    without another copy."""
+    samples = [source for source, _ in batch] + [target for _, target in batch]
+    images = [image for image, _ in samples]
+    out = None
+    if torch.utils.data.get_worker_info() is not None:
+        numel = sum(image.numel() for image in images)
+        storage = images[0]._typed_storage()._new_shared(numel, device=images[0].device)
+        out = images[0].new(storage).resize_(len(images), *list(images[0].size()))
+    inputs = torch.stack(images, 0, out=out)
+    labels = torch.tensor([label for _, label in samples])
+    return inputs, labels[:len(batch)], labels[len(batch):]
+
+
+def paired_loader(source, target, batch_size, workers=4, pin_memory=True):
+    """DataLoader of endless (inputs, source labels, target labels) batches,
+    see paired_collate. Its single iterator, and so its worker processes,
+    live for the whole run, and batches run across epoch boundaries instead
+    of coming up short."""
+    return torch.utils.data.DataLoader(
+        PairedDataset(source, target),
+        batch_sampler=PairedBatchSampler(len(source), len(target), batch_size),
+        collate_fn=paired_collate, num_workers=workers, pin_memory=pin_memory)
+
+
+class DevicePrefetcher(object):
+    """Iterates over iterable with `depth` batches already on their way to
+    the GPU. Host tensors that are not pinned are first copied into a ring of
+    reusable pinned buffers; all copies then run non_blocking on a side CUDA
+    stream, so batch k+1 transfers while batch k computes. Batches may be
+    nested tuples/lists of tensors. Without CUDA batches pass through as is."""
+
+    def __init__(self, iterable, depth=2):
+        self.iterator = iter(iterable)
+        self.depth = max(1, depth)
+        self.enabled = torch.cuda.is_available()
+        if self.enabled:
+            self.stream = torch.cuda.Stream()
+            self.pinned = [None] * (self.depth + 1)
+            self.events = [None] * (self.depth + 1)
+            self.slot = 0
+            self.queue = collections.deque()
+
+    def __iter__(self):
+        return self
+
+    def pin(self, batch, buffers):
+        if torch.is_tensor(batch):
+            if batch.is_cuda or batch.is_pinned():
+                return batch, batch
+            if buffers is None or buffers.size() != batch.size() or buffers.dtype != batch.dtype:
+                buffers = torch.empty(batch.size(), dtype=batch.dtype).pin_memory()
+            return buffers.copy_(batch), buffers
+        if isinstance(batch, (tuple, list)):
+            if not isinstance(buffers, list) or len(buffers) != len(batch):
+                buffers = [None] * len(batch)
+            pinned = [self.pin(item, buffer) for item, buffer in zip(batch, buffers)]
+            return type(batch)(item for item, _ in pinned), [buffer for _, buffer in pinned]
+        return batch, None
+
+    def to_device(self, batch):
+        if torch.is_tensor(batch):
+            return batch.cuda(non_blocking=True)
+        if isinstance(batch, (tuple, list)):
+            return type(batch)(self.to_device(item) for item in batch)
+        return batch
+
+    def release(self, batch):
+        if torch.is_tensor(batch):
+            batch.record_stream(torch.cuda.current_stream())
+        elif isinstance(batch, (tuple, list)):
+            for item in batch:
+                self.release(item)
+
+    def preload(self):
+        batch = next(self.iterator)
+        slot = self.slot
+        self.slot = (slot + 1) % len(self.pinned)
+        if self.events[slot] is not None:
+            # the slot's previous host-to-device copy must be done
+            self.events[slot].synchronize()
+        batch, self.pinned[slot] = self.pin(batch, self.pinned[slot])
+        with torch.cuda.stream(self.stream):
+            batch = self.to_device(batch)
+            self.events[slot] = torch.cuda.Event()
+            self.events[slot].record(self.stream)
+        self.queue.append((batch, self.events[slot]))
+
+    def __next__(self):
+        if not self.enabled:
+            return next(self.iterator)
+        try:
+            while len(self.queue) < self.depth:
+                self.preload()
+        except StopIteration:
+            if not self.queue:
+                raise
+        batch, event = self.queue.popleft()
+        torch.cuda.current_stream().wait_event(event)
+        self.release(batch)
+        return batch
+
+    next = __next__
+
+
+def to_uint8_tensor(img):
+    """PIL image to an (H, W, 3) uint8 tensor, for BatchTransform."""
+    return torch.from_numpy(np.array(img.convert('RGB'), dtype=np.uint8))
+
+
+class MemmapImageFolder(torch.utils.data.Dataset):
+    """The samples of a build_image_cache directory, as PIL images read
+    from the memory-mapped array and passed through transform. The array is
+    mapped lazily, so every worker process maps it on its own."""
+
+    def __init__(self, cache_dir, transform=None):
+        self.cache_dir = cache_dir
+        self.transform = transform
+        self.targets = np.load(os.path.join(cache_dir, 'labels.npy'))
+        self.images = None
+
+    def __len__(self):
+        return len(self.targets)
+
+    def __getitem__(self, index):
+        if self.images is None:
+            self.images = np.load(os.path.join(self.cache_dir, 'images.npy'), mmap_mode='r')
+        img = Image.fromarray(self.images[index])
+        if self.transform is not None:
+            img = self.transform(img)
+        return img, int(self.targets[index])
+
+
+class DecodeCache(object):
+    """LRU cache of decoded, MyScale(size) resized images keyed by path,
+    shared by every dataset and worker process holding it. Use it as the
+    ImageFolder loader, without MyScale in the transform.
+
+    Images sit in fixed-size slots of a shared-memory uint8 tensor, as many
+    as fit in budget bytes. The path -> slot table, slot owners and last-use
+    clock are shared tensors updated under one multiprocessing lock, and a
+    miss evicts the least recently used slot. The paths are the images under
+    roots, indexed when the cache is built, i.e. before any worker forks."""
+
+    def __init__(self, roots, budget, size=(256, 256), loader=None):
+        paths = sorted(set(path for root in roots
+                           for path, _ in datasets.ImageFolder(root).samples))
+        self.index = dict((path, i) for i, path in enumerate(paths))
+        slots = max(1, min(len(paths), int(budget // (size[0] * size[1] * 3))))
+        self.images = torch.empty(slots, size[1], size[0], 3, dtype=torch.uint8).share_memory_()
+        self.slot_of = torch.full((len(paths),), -1, dtype=torch.long).share_memory_()
+        self.owner = torch.full((slots,), -1, dtype=torch.long).share_memory_()
+        self.last_use = torch.zeros(slots, dtype=torch.long).share_memory_()
+        # clock, hits, misses
+        self.counters = torch.zeros(3, dtype=torch.long).share_memory_()
+        self.lock = multiprocessing.Lock()
+        self.scale = MyScale(size)
+        self.loader = loader or DraftLoader(size)
+
+    def __call__(self, path):
+        key = self.index[path]
+        with self.lock:
+            slot = int(self.slot_of[key])
+            if slot >= 0:
+                self.counters[0] += 1
+                self.counters[1] += 1
+                self.last_use[slot] = self.counters[0]
+                return Image.fromarray(self.images[slot].numpy().copy())
+        array = np.asarray(self.scale(self.loader(path)).convert('RGB'))
+        with self.lock:
+            self.counters[0] += 1
+            self.counters[2] += 1
+            if int(self.slot_of[key]) < 0:
+                slot = int(self.last_use.argmin())
+                if int(self.owner[slot]) >= 0:
+                    self.slot_of[self.owner[slot]] = -1
+                self.images[slot] = torch.from_numpy(array)
+                self.owner[slot] = key
+                self.slot_of[key] = slot
+                self.last_use[slot] = self.counters[0]
+        return Image.fromarray(array)
+
+    def stats(self):
+        """(hits, misses) over all processes so far."""
+        return int(self.counters[1]), int(self.counters[2])
+
+
+def image_folder(root, transform, cache_root=None, size=(256, 256), decode_cache=None,
+                 loader=None):
+    """ImageFolder over root with MyScale(size) ahead of the transform list,
+    decoding with loader (a DraftLoader by default) or reading through a
+    shared DecodeCache. Given cache_root, the samples are served from a
+    uint8 cache of root under it instead, built on first use."""
+    if not cache_root and decode_cache is not None:
+        return datasets.ImageFolder(root, transforms.Compose(transform), loader=decode_cache)
+    if not cache_root:
+        return datasets.ImageFolder(root, transforms.Compose([MyScale(size)] + transform),
+                                    loader=loader or DraftLoader(size))
+    cache_dir = os.path.join(cache_root, root.strip(os.sep).replace(os.sep, '_'))
+    if not os.path.exists(os.path.join(cache_dir, 'images.npy')):
+        build_image_cache(root, cache_dir, size, loader=loader)
+    return MemmapImageFolder(cache_dir, transforms.Compose(transform))
+
+
+class BatchTransform(object):
+    """Batched counterpart of RandomSizedCrop(size), RandomHorizontalFlip,
+    ToTensor and Normalize (train) or of CenterCrop(size), ToTensor and
+    Normalize, on an (B, H, W, 3) uint8 batch, on `device`.
+
+    Crop boxes follow RandomResizedCrop: up to 10 draws of area fraction in
+    scale and log-uniform aspect ratio in ratio, falling back to a central
+    crop. All crops are resampled in one bilinear grid_sample, which does not
+    antialias the way PIL does when shrinking a large crop."""
+
+    def __init__(self, size=224, train=True, mean=(0.485, 0.456, 0.406),
+                 std=(0.229, 0.224, 0.225), scale=(0.08, 1.0), ratio=(3. / 4., 4. / 3.),
+                 device=None):
+        self.size = size
+        self.train = train
+        self.scale = scale
+        self.ratio = ratio
+        self.device = device
+        self.mean = torch.tensor(mean).view(1, 3, 1, 1) * 255
+        self.std = torch.tensor(std).view(1, 3, 1, 1) * 255
+
+    def crop_boxes(self, batch_size, height, width, device, attempts=10):
+        """(B, 4) float tensor of (top, left, crop height, crop width)."""
+        area = height * width
+        target_area = area * torch.empty(batch_size, attempts, device=device).uniform_(*self.scale)
+        log_ratio = torch.empty(batch_size, attempts, device=device).uniform_(
+            math.log(self.ratio[0]), math.log(self.ratio[1]))
+        aspect_ratio = torch.exp(log_ratio)
+        w = torch.round(torch.sqrt(target_area * aspect_ratio))
+        h = torch.round(torch.sqrt(target_area / aspect_ratio))
+        valid = (w > 0) & (w <= width) & (h > 0) & (h <= height)
+        first = valid.float().argmax(1, keepdim=True)
+        w, h = w.gather(1, first).squeeze(1), h.gather(1, first).squeeze(1)
+        found = valid.any(1)
+
+        in_ratio = float(width) / float(height)
+        if in_ratio < min(self.ratio):
+            fallback_w, fallback_h = width, int(round(width / min(self.ratio)))
+        elif in_ratio > max(self.ratio):
+            fallback_w, fallback_h = int(round(height * max(self.ratio))), height
+        else:
+            fallback_w, fallback_h = width, height
+        w = torch.where(found, w, torch.full_like(w, fallback_w))
+        h = torch.where(found, h, torch.full_like(h, fallback_h))
+        top = torch.floor(torch.rand(batch_size, device=device) * (height - h + 1))
+        left = torch.floor(torch.rand(batch_size, device=device) * (width - w + 1))
+        top = torch.where(found, top, torch.round((height - h) / 2.))
+        left = torch.where(found, left, torch.round((width - w) / 2.))
+        return torch.stack([top, left, h, w], 1)
+
+    def __call__(self, images):
+        if self.device is not None:
+            images = images.to(self.device, non_blocking=True)
+        batch_size, height, width = images.size(0), images.size(1), images.size(2)
+        mean, std = self.mean.to(images.device), self.std.to(images.device)
+        if not self.train:
+            top = int(round((height - self.size) / 2.))
+            left = int(round((width - self.size) / 2.))
+            images = images[:, top:top + self.size, left:left + self.size]
+            return (images.permute(0, 3, 1, 2).float() - mean) / std
+        top, left, h, w = self.crop_boxes(batch_size, height, width, images.device).unbind(1)
+        flip = torch.where(torch.rand(batch_size, device=images.device) < 0.5,
+                           -torch.ones_like(w), torch.ones_like(w))
+        # output [-1, 1] coordinates to the crop box, align_corners=False
+        theta = torch.zeros(batch_size, 2, 3, device=images.device)
+        theta[:, 0, 0] = w / width * flip
+        theta[:, 0, 2] = (2 * left + w) / width - 1
+        theta[:, 1, 1] = h / height
+        theta[:, 1, 2] = (2 * top + h) / height - 1
+        grid = F.affine_grid(theta, (batch_size, 3, self.size, self.size), align_corners=False)
+        images = images.permute(0, 3, 1, 2).float()
+        images = F.grid_sample(images, grid, mode='bilinear', padding_mode='border',
+                               align_corners=False)
+        return (images - mean) / std
+
+
+class BatchTransformLoader(object):
+    """Iterates over loader applying transform to the images, the first
+    item of each batch."""
+
+    def __init__(self, loader, transform):
+        self.loader = loader
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        for batch in self.loader:
+            yield (self.transform(batch[0]),) + tuple(batch[1:])
+
+
+def benchmark(root, workers=(0, 1, 2, 4), size=(256, 256), batch_size=32, images=512):
+    """Images/sec, in total and per worker, of decoding and resizing the
+    images under root with MyScale(size), with full and draft decoding."""
+    loaders = [('full', datasets.folder.default_loader), ('draft', DraftLoader(size))]
+    for name, loader in loaders:
+        dataset = datasets.ImageFolder(root, transforms.Compose([MyScale(size), to_uint8_tensor]),
+                                       loader=loader)
+        for worker_num in workers:
+            data = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=True,
+                                               num_workers=worker_num)
+            count = 0
+            end = time.time()
+            for batch, _ in data:
+                count += len(batch)
+                if count >= images:
+                    break
+            rate = count / (time.time() - end)
+            print('{:5s} {} workers: {:8.1f} images/sec, {:8.1f} per worker'.format(
+                name, worker_num, rate, rate / max(worker_num, 1)))
+
+
+if __name__ == '__main__':
+    benchmark(sys.argv[1], [int(n) for n in sys.argv[2:]] or (0, 1, 2, 4))
@@ -4,6 +4,8 @@ import os
 import shutil
 import time
 import itertools
+import collections
+import math
 import numpy as np
 
 import torch
@@ -16,63 +18,605 @@ import torchvision.transforms as transforms
 import torchvision.datasets as datasets
 import torchvision.models as models
 
-def guassian_kernel(source, target, kernel_mul=2.0, kernel_num=5, fix_sigma=None):
-    n_samples = int(source.size()[0])+int(target.size()[0])
-    total = torch.cat([source, target])
-    L2_distance = ((total.unsqueeze(1)-total.unsqueeze(0))**2).sum(2)
-    if fix_sigma:
+def pairwise_distance(x, y=None):
+    """Squared euclidean distances between the rows of x and y (x if None).
+
+    Built from squared norms plus one matmul, so only the (N, M) result is
+    kept for backward instead of an (N, M, D) difference tensor. Rounding
+    can push near-zero entries below zero; they are clamped."""
+    x_norm = (x ** 2).sum(1).view(-1, 1)
+    if y is None:
+        y, y_norm = x, x_norm.view(1, -1)
+    else:
+        y_norm = (y ** 2).sum(1).view(1, -1)
+    distance = torch.addmm(x_norm + y_norm, x, y.t(), beta=1, alpha=-2)
+    return torch.clamp(distance, min=0.0)
+
+
+def pairwise_distances(xs, ys=None):
+    """pairwise_distance for every layer pair (xs[l], ys[l]), with layers of
+    equal width stacked into a single batched matmul."""
+    ys = xs if ys is None else ys
+    distances = [None] * len(xs)
+    groups = collections.OrderedDict()
+    for i, x in enumerate(xs):
+        groups.setdefault(tuple(x.size()[1:]), []).append(i)
+    for index in groups.values():
+        if len(index) == 1:
+            i = index[0]
+            distances[i] = pairwise_distance(xs[i], None if ys is xs else ys[i])
+            continue
+        x = torch.stack([xs[i] for i in index])
+        y = None if ys is xs else torch.stack([ys[i] for i in index])
+        for i, layer_distance in zip(index, batch_pairwise_distance(x, y).unbind(0)):
+            distances[i] = layer_distance
+    return distances
+
+
+def batch_pairwise_distance(x, y=None):
+    """pairwise_distance over the leading batch dimension of x and y."""
+    x_norm = (x ** 2).sum(2, keepdim=True)
+    if y is None:
+        y, y_norm = x, x_norm
+    else:
+        y_norm = (y ** 2).sum(2, keepdim=True)
+    distance = torch.baddbmm(x_norm + y_norm.transpose(1, 2), x, y.transpose(1, 2),
+                             beta=1, alpha=-2)
+    return torch.clamp(distance, min=0.0)
+
+
+def pairwise_distance_grad(grad_distance, x, y):
+    """Gradients w.r.t. x and y of sum(grad_distance * pairwise_distance(x, y))."""
+    return (2. * (grad_distance.sum(1, keepdim=True) * x - grad_distance.mm(y)),
+            2. * (grad_distance.sum(0).view(-1, 1) * y - grad_distance.t().mm(x)))
+
+
+def mean_pairwise_distance(total):
+    """Mean off-diagonal squared distance between the rows of total in
+    O(N*D), from sum_ij |x_i - x_j|^2 = 2N sum_i |x_i - mean|^2."""
+    n_samples = int(total.size()[0])
+    total = total.data
+    centered = total - total.mean(0, keepdim=True)
+    return 2 * n_samples * (centered ** 2).sum() / (n_samples**2-n_samples)
+
+
+def base_bandwidth(total, kernel_mul=2.0, kernel_num=5, fix_sigma=None):
+    """Smallest bandwidth of the family bw * kernel_mul**i, i < kernel_num,
+    centred on fix_sigma, on a BandwidthEstimator's value, or else on the
+    batch's mean pairwise distance."""
+    if isinstance(fix_sigma, BandwidthEstimator):
+        bandwidth = fix_sigma(total)
+    elif fix_sigma:
         bandwidth = fix_sigma
     else:
-        bandwidth = torch.sum(L2_distance.data) / (n_samples**2-n_samples)
-    bandwidth /= kernel_mul ** (kernel_num // 2)
-    bandwidth_list = [bandwidth * (kernel_mul**i) for i in range(kernel_num)]
-    kernel_val = [torch.exp(-L2_distance / bandwidth_temp) for bandwidth_temp in bandwidth_list]
-    return sum(kernel_val), L2_distance
+        bandwidth = mean_pairwise_distance(total)
+    return bandwidth / kernel_mul ** (kernel_num // 2)
 
 
-def MMDLoss(source, target, kernel_mul=2.0, kernel_num=5, fix_sigma=None):
-    batch_size = int(source.size()[0])
-    kernels, _ = guassian_kernel(source, target,
-        kernel_mul=kernel_mul, kernel_num=kernel_num, fix_sigma=fix_sigma)
+class BandwidthEstimator(object):
+    """Kernel bandwidth cached across iterations. step(total), called once per
+    iteration, folds the batch estimate (the mean pairwise distance, or with
+    method='median' the median over `subsample` random rows) into an EMA
+    every update_every iterations; pass the estimator in place of a fix_sigma."""
+
+    def __init__(self, momentum=0.9, update_every=1, method='mean', subsample=64):
+        self.momentum = momentum
+        self.update_every = update_every
+        self.method = method
+        self.subsample = subsample
+        self.steps = 0
+        self.bandwidth = None
+
+    def estimate(self, total):
+        if self.method == 'median':
+            total = total.data
+            if total.size(0) > self.subsample:
+                index = torch.randperm(total.size(0), device=total.device)[:self.subsample]
+                total = total[index]
+            n_samples = int(total.size(0))
+            distance = pairwise_distance(total)
+            off_diagonal = ~torch.eye(n_samples, dtype=torch.bool, device=total.device)
+            return distance[off_diagonal].median()
+        return mean_pairwise_distance(total)
+
+    def step(self, total):
+        if self.bandwidth is None:
+            self.bandwidth = self.estimate(total)
+        elif self.update_every and self.steps % self.update_every == 0:
+            self.bandwidth = self.momentum * self.bandwidth + \
+                             (1 - self.momentum) * self.estimate(total)
+        self.steps += 1
+
+    def __call__(self, total):
+        """The cached bandwidth, or total's own estimate before the first step."""
+        if self.bandwidth is None:
+            return self.estimate(total)
+        return self.bandwidth
+
+    def state_dict(self):
+        return {'bandwidth': self.bandwidth, 'steps': self.steps}
+
+    def load_state_dict(self, state_dict):
+        self.bandwidth = state_dict['bandwidth']
+        self.steps = state_dict['steps']
+
+
+def bandwidth_estimator(args):
+    """Builds the feature-layer bandwidth estimator selected by --bandwidth."""
+    if args.bandwidth == 'batch':
+        return None
+    return BandwidthEstimator(args.bandwidth_momentum, args.bandwidth_every,
+                              method=args.bandwidth)
+
+
+def multi_bandwidth_log(L2_distance, bandwidth, kernel_mul=2.0, kernel_num=5):
+    """Returns log K = log sum_i exp(-D / bw_i), bw_i = bandwidth * kernel_mul**i,
+    and the rate -d log K / dD, from one exp when kernel_mul is an integer."""
+    if float(kernel_mul).is_integer():
+        power = int(kernel_mul)
+        bandwidth_max = bandwidth * kernel_mul ** (kernel_num - 1)
+        widest = torch.exp(-L2_distance / bandwidth_max)
+        step = widest ** (power - 1)
+        # ratio of the i-th kernel to the widest one, exp(-D / bw_i) / widest
+        ratio = torch.ones_like(L2_distance)
+        ratio_sum = ratio.clone()
+        rate = ratio / bandwidth_max
+        for i in range(kernel_num - 2, -1, -1):
+            ratio = ratio ** power * step
+            ratio_sum += ratio
+            rate += ratio / (bandwidth * kernel_mul ** i)
+        return torch.log(ratio_sum) - L2_distance / bandwidth_max, rate / ratio_sum
+    scales = L2_distance.new_tensor([kernel_mul ** i for i in range(kernel_num)])
+    bandwidth_list = (bandwidth * scales).view((-1,) + (1,) * L2_distance.dim())
+    logits = -L2_distance.unsqueeze(0) / bandwidth_list
+    weights = F.softmax(logits, 0)
+    return torch.logsumexp(logits, 0), (weights / bandwidth_list).sum(0)
+
+
+def joint_log_kernel(distances, bandwidths, kernel_muls, kernel_nums):
+    """Log of the product over layers of multi-bandwidth gaussian kernels,
+    accumulated as a sum of logs so three or more layers do not underflow,
+    plus each layer's rate (see multi_bandwidth_log)."""
+    log_joint = 0
+    rates = []
+    for distance, bandwidth, kernel_mul, kernel_num in zip(
+            distances, bandwidths, kernel_muls, kernel_nums):
+        log_kernel, rate = multi_bandwidth_log(distance, bandwidth, kernel_mul, kernel_num)
+        log_joint = log_joint + log_kernel
+        rates.append(rate)
+    return log_joint, rates
+
+
+class JointGaussianKernel(torch.autograd.Function):
+    """Product over layers of multi-bandwidth gaussian kernels of the layers'
+    squared distance matrices, keeping only d joint / d D_l for backward."""
+
+    @staticmethod
+    def forward(ctx, bandwidths, kernel_muls, kernel_nums, *distances):
+        log_joint, rates = joint_log_kernel(distances, bandwidths, kernel_muls, kernel_nums)
+        joint = torch.exp(log_joint)
+        ctx.save_for_backward(*[-joint * rate for rate in rates])
+        return joint
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        grads = tuple(grad_output * coefficient for coefficient in ctx.saved_tensors)
+        return (None, None, None) + grads
+
+
+def guassian_kernel(source, target, kernel_mul=2.0, kernel_num=5, fix_sigma=None):
+    total = torch.cat([source, target])
+    L2_distance = pairwise_distance(total)
+    bandwidth = base_bandwidth(total, kernel_mul, kernel_num, fix_sigma)
+    kernel_val = JointGaussianKernel.apply(
+        [bandwidth], [kernel_mul], [kernel_num], L2_distance)
+    return kernel_val, L2_distance
+
+
+def linear_index(batch_size, device=None):
+    """Rows and columns of the (s1,s2), (t1,t2), (s1,t2), (s2,t1) entries
+    used by the linear-time estimator, stacked in that order."""
+    s1 = torch.arange(batch_size, dtype=torch.long, device=device)
+    s2 = (s1 + 1) % batch_size
+    t1, t2 = s1 + batch_size, s2 + batch_size
+    return torch.cat([s1, t1, s1, s2]), torch.cat([s2, t2, t2, t1])
+
+
+def linear_kernel_sum(kernels, batch_size):
+    """Sums the linear-time estimator terms k(s1,s2)+k(t1,t2)-k(s1,t2)-k(s2,t1)
+    over all (s1, s2, t1, t2) quadruples, gathered in a single indexing op."""
+    rows, cols = linear_index(batch_size, kernels.device)
+    terms = kernels[rows, cols].view(4, batch_size)
+    return (terms[0] + terms[1] - terms[2] - terms[3]).sum()
+
+
+def linear_kernel_sum_loop(kernels, batch_size):
+    """Reference per-sample loop for `linear_kernel_sum`."""
     loss = 0
     for i in range(batch_size):
         s1, s2 = i, (i+1)%batch_size
         t1, t2 = s1+batch_size, s2+batch_size
         loss += kernels[s1, s2] + kernels[t1, t2]
         loss -= kernels[s1, t2] + kernels[s2, t1]
+    return loss
+
+
+LINEAR_ESTIMATORS = {
+    'batched': linear_kernel_sum,
+    'loop': linear_kernel_sum_loop,
+}
+
+
+def mmd_weights(batch_size, b_test=False, like=None):
+    """(2B, 2B) matrix W such that sum(W * K) is the normalized MMD estimate
+    of the kernel matrix K: the biased quadratic statistic if b_test, else
+    the linear-time one."""
+    n_samples = 2 * batch_size
+    weights = like.new_zeros(n_samples, n_samples)
+    if b_test:
+        weights[:batch_size, :batch_size] = 1.
+        weights[batch_size:, batch_size:] = 1.
+        weights[:batch_size, batch_size:] = -1.
+        weights[batch_size:, :batch_size] = -1.
+        return weights / float(batch_size)**2
+    rows, cols = linear_index(batch_size, like.device)
+    signs = like.new_tensor([1., 1., -1., -1.]).repeat_interleave(batch_size)
+    weights.index_put_((rows, cols), signs, accumulate=True)
+    return weights / float(batch_size)
+
+
+def block_jmmd(source_list, target_list, block, kernel_muls, kernel_nums, fix_sigma_list):
+    """Unbiased (J)MMD averaged over B // block blocks of paired rows, in
+    O(B * block); leftover rows are dropped."""
+    batch_size = int(source_list[0].size()[0])
+    block = max(2, min(block, batch_size))
+    block_num = batch_size // block
+    used = block_num * block
+    distances, bandwidths = [], []
+    for source, target, kernel_mul, kernel_num, fix_sigma in zip(
+            source_list, target_list, kernel_muls, kernel_nums, fix_sigma_list):
+        bandwidths.append(base_bandwidth(torch.cat([source, target]), kernel_mul,
+                                         kernel_num, fix_sigma))
+        blocks = torch.cat([source[:used].contiguous().view(block_num, block, -1),
+                            target[:used].contiguous().view(block_num, block, -1)], 1)
+        distances.append(batch_pairwise_distance(blocks))
+    joint = JointGaussianKernel.apply(bandwidths, kernel_muls, kernel_nums, *distances)
+    off_diagonal = 1. - torch.eye(block, dtype=joint.dtype, device=joint.device)
+    weights = torch.cat([torch.cat([off_diagonal, -off_diagonal], 1),
+                         torch.cat([-off_diagonal, off_diagonal], 1)])
+    return (joint * weights).sum() / float(used * (block - 1))
+
+
+class JMMDFunction(torch.autograd.Function):
+    """JMMD of stacked [source; target] layer activations, keeping only the
+    inputs and the weighted joint kernel for an analytic backward."""
+
+    @staticmethod
+    def forward(ctx, kernel_muls, kernel_nums, fix_sigma_list, b_test, *totals):
+        batch_size = int(totals[0].size()[0]) // 2
+        bandwidths = [base_bandwidth(total, kernel_mul, kernel_num, fix_sigma)
+                      for total, kernel_mul, kernel_num, fix_sigma in zip(
+                          totals, kernel_muls, kernel_nums, fix_sigma_list)]
+        log_joint, _ = joint_log_kernel(pairwise_distances(totals), bandwidths,
+                                        kernel_muls, kernel_nums)
+        joint = torch.exp(log_joint)
+        weighted = mmd_weights(batch_size, b_test, like=joint) * joint
+        ctx.kernel_params = (bandwidths, kernel_muls, kernel_nums)
+        ctx.save_for_backward(weighted, *totals)
+        return weighted.sum()
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        weighted, totals = ctx.saved_tensors[0], ctx.saved_tensors[1:]
+        _, rates = joint_log_kernel(pairwise_distances(totals), *ctx.kernel_params)
+        grads = []
+        for total, rate in zip(totals, rates):
+            grad_rows, grad_cols = pairwise_distance_grad(-weighted * rate, total, total)
+            grads.append(grad_output * (grad_rows + grad_cols))
+        return (None, None, None, None) + tuple(grads)
+
+
+class RandomFourierMMD(object):
+    """Random Fourier feature approximation of the (J)MMD quadratic statistic.
+
+    The joint kernel prod_l sum_i exp(-|x_l - y_l|^2 / bw_li) expands into
+    one gaussian per combination c of per-layer bandwidths, which is a unit
+    gaussian on the concatenation of x_l / sqrt(bw_lc). Each combination is
+    mapped to rff_dim cos/sin features, and the loss is the squared distance
+    between the source and target mean embeddings, in O(B * D * rff_dim)
+    per combination. Projections are redrawn every resample_every calls
+    (never, if 0)."""
+
+    def __init__(self, rff_dim=1024, resample_every=1):
+        self.rff_dim = rff_dim
+        self.resample_every = resample_every
+        self.calls = 0
+        self.projections = None
+
+    def resample(self, totals, combo_num):
+        self.projections = [
+            total.data.new(combo_num * self.rff_dim, total.size(1)).normal_(0, math.sqrt(2.))
+            for total in totals]
+
+    def __call__(self, source_list, target_list, kernel_muls, kernel_nums, fix_sigma_list):
+        batch_size = int(source_list[0].size()[0])
+        layer_num = len(source_list)
+        totals = [torch.cat([source_list[i], target_list[i]]) for i in range(layer_num)]
+        combos = list(itertools.product(*[range(kernel_nums[i]) for i in range(layer_num)]))
+        shapes = [(len(combos) * self.rff_dim, total.size(1)) for total in totals]
+        if (self.projections is None or
+                [tuple(w.size()) for w in self.projections] != shapes or
+                (self.resample_every and self.calls % self.resample_every == 0)):
+            self.resample(totals, len(combos))
+        self.calls += 1
+
+        projection = 0
+        for i, total in enumerate(totals):
+            kernel_mul, kernel_num, fix_sigma = kernel_muls[i], kernel_nums[i], fix_sigma_list[i]
+            bandwidth = base_bandwidth(total, kernel_mul, kernel_num, fix_sigma)
+            scales = total.new_tensor([kernel_mul ** -(0.5 * combo[i]) for combo in combos])
+            scales = (scales / bandwidth ** 0.5).repeat_interleave(self.rff_dim)
+            projection = projection + total.mm(self.projections[i].t()) * scales
+        features = torch.cat([torch.cos(projection), torch.sin(projection)], 1)
+        source_mean = features[:batch_size].mean(0)
+        target_mean = features[batch_size:].mean(0)
+        return ((source_mean - target_mean) ** 2).sum() / float(self.rff_dim)
+
+
+def mmd_approximation(args):
+    """Builds the approximate (J)MMD estimator selected by --mmd-approx."""
+    if args.mmd_approx == 'rff':
+        return RandomFourierMMD(args.rff_dim, args.rff_resample)
+    return None
+
+
+def tile_size(memory_budget, layer_num, element_size=4):
+    """Largest tile edge t whose per-tile temporaries, about 4 (t, t)
+    matrices per layer plus the joint kernel and its gradient, fit in
+    memory_budget megabytes."""
+    matrices = 4 * layer_num + 2
+    return max(1, int(math.sqrt(memory_budget * 2**20 / (element_size * matrices))))
+
+
+class TiledJMMDFunction(torch.autograd.Function):
+    """Biased quadratic (b_test) JMMD summed over (tile, tile) blocks, so the
+    (2B, 2B) joint kernel is never held whole."""
+
+    @staticmethod
+    def kernel_tiles(totals, params, tile):
+        n_samples = int(totals[0].size()[0])
+        for row in range(0, n_samples, tile):
+            for col in range(0, n_samples, tile):
+                distances = pairwise_distances([total[row:row+tile] for total in totals],
+                                               [total[col:col+tile] for total in totals])
+                log_joint, rates = joint_log_kernel(distances, *params)
+                yield row, col, torch.exp(log_joint), rates
+
+    @staticmethod
+    def tile_signs(row, col, shape, batch_size, like):
+        rows = torch.arange(row, row + shape[0], device=like.device) < batch_size
+        cols = torch.arange(col, col + shape[1], device=like.device) < batch_size
+        same = rows.view(-1, 1) == cols.view(1, -1)
+        return same.to(like.dtype) * 2 - 1
+
+    @staticmethod
+    def forward(ctx, kernel_muls, kernel_nums, fix_sigma_list, tile, *totals):
+        batch_size = int(totals[0].size()[0]) // 2
+        bandwidths = []
+        for total, kernel_mul, kernel_num, fix_sigma in zip(
+                totals, kernel_muls, kernel_nums, fix_sigma_list):
+            bandwidths.append(base_bandwidth(total, kernel_mul, kernel_num, fix_sigma))
+        params = (bandwidths, kernel_muls, kernel_nums)
+        loss = 0
+        for row, col, joint, _ in TiledJMMDFunction.kernel_tiles(totals, params, tile):
+            signs = TiledJMMDFunction.tile_signs(row, col, joint.size(), batch_size, joint)
+            loss = loss + (signs * joint).sum()
+        ctx.params = params
+        ctx.tile = tile
+        ctx.save_for_backward(*totals)
+        return loss / float(batch_size)**2
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        totals = ctx.saved_tensors
+        batch_size = int(totals[0].size()[0]) // 2
+        scale = grad_output / float(batch_size)**2
+        grads = [torch.zeros_like(total) for total in totals]
+        for row, col, joint, rates in TiledJMMDFunction.kernel_tiles(totals, ctx.params, ctx.tile):
+            weighted = TiledJMMDFunction.tile_signs(row, col, joint.size(), batch_size, joint) * joint
+            for total, grad, rate in zip(totals, grads, rates):
+                grad_rows, grad_cols = pairwise_distance_grad(
+                    -weighted * rate, total[row:row+ctx.tile], total[col:col+ctx.tile])
+                grad[row:row+ctx.tile] += scale * grad_rows
+                grad[col:col+ctx.tile] += scale * grad_cols
+        return (None, None, None, None) + tuple(grads)
+
+
+def MMDLoss(source, target, kernel_mul=2.0, kernel_num=5, fix_sigma=None,
+            linear='batched', approx=None, block=0):
+    if approx is not None:
+        return approx([source], [target], [kernel_mul], [kernel_num], [fix_sigma])
+    if block:
+        return block_jmmd([source], [target], block, [kernel_mul], [kernel_num], [fix_sigma])
+    batch_size = int(source.size()[0])
+    kernels, _ = guassian_kernel(source, target,
+        kernel_mul=kernel_mul, kernel_num=kernel_num, fix_sigma=fix_sigma)
+    loss = LINEAR_ESTIMATORS[linear](kernels, batch_size)
     return loss / float(batch_size)
 
 
+def ClassMMDLoss(source, target, source_label, target_prob, num_classes, kernel_mul=2.0,
+                 kernel_num=5, fix_sigma=None, inter_weight=1.):
+    """Class-conditional MMD: mean intra-class MMD between source and target
+    samples of the same class, minus inter_weight times the mean MMD between
+    source class c and target class c' != c.
+
+    Source samples are assigned by one-hot labels, target samples softly by
+    target_prob (not differentiated through). With Z the block-diagonal
+    (2B, 2C) matrix of column-normalized assignments, Z^T K Z holds every
+    class-pair kernel mean, so all C classes cost one kernel-by-assignment
+    matmul. Classes missing from either side of the batch are skipped."""
+    kernels, _ = guassian_kernel(source, target, kernel_mul=kernel_mul,
+                                 kernel_num=kernel_num, fix_sigma=fix_sigma)
+    batch_size = int(source.size()[0])
+    source_assign = source.new_zeros(batch_size, num_classes).scatter_(
+        1, source_label.view(-1, 1), 1.)
+    target_assign = target_prob.detach()
+    source_count, target_count = source_assign.sum(0), target_assign.sum(0)
+    present = (source_count > 0) & (target_count > 1e-3)
+    assign = source.new_zeros(2 * batch_size, 2 * num_classes)
+    assign[:batch_size, :num_classes] = source_assign / source_count.clamp(min=1.)
+    assign[batch_size:, num_classes:] = target_assign / target_count.clamp(min=1e-3)
+    means = assign.t().mm(kernels.mm(assign))
+    ss = means[:num_classes, :num_classes].diag()
+    tt = means[num_classes:, num_classes:].diag()
+    st = means[:num_classes, num_classes:]
+    # class_mmd[c, c'] = MMD between source class c and target class c'
+    class_mmd = ss.view(-1, 1) + tt.view(1, -1) - 2 * st
+    pair_mask = (present.view(-1, 1) & present.view(1, -1)).float()
+    intra_mask = torch.diag(pair_mask.diag())
+    inter_mask = pair_mask - intra_mask
+    intra = (class_mmd * intra_mask).sum() / intra_mask.sum().clamp(min=1.)
+    inter = (class_mmd * inter_mask).sum() / inter_mask.sum().clamp(min=1.)
+    return intra - inter_weight * inter
+
+
+def knn_graph_loss(feature_kernel, output_distance, knn=3):
+    """Sum over the rows i and each row's knn nearest neighbours j under the
+    feature kernel of feature_kernel[i, j] * output_distance[i, j]."""
+    _, indices = torch.topk(feature_kernel.detach(), knn, dim=1)
+    return (feature_kernel.gather(1, indices) * output_distance.gather(1, indices)).sum()
+
+
+class FeatureBank(object):
+    """Queue of the last `size` detached target (and, if `source`, source)
+    activations of every JMMD layer.
+
+    Calling it returns weight times the biased quadratic JMMD between the
+    current source batch and the banked targets (plus the current target
+    batch against the banked sources), then enqueues the batch. The
+    bank-bank kernel mean has no gradient and is left out, so the value is
+    the JMMD minus a constant; it is on the b_test scale, not the linear one."""
+
+    def __init__(self, size, source=False, weight=1.):
+        self.size = size
+        self.source = source
+        self.weight = weight
+        self.banks = {'source': None, 'target': None}
+        self.pointer = 0
+        self.count = 0
+
+    def enqueue(self, source_list, target_list):
+        batch_size = int(source_list[0].size()[0])
+        index = (self.pointer + torch.arange(batch_size, device=source_list[0].device)) % self.size
+        for domain, layers in (('source', source_list), ('target', target_list)):
+            if domain == 'source' and not self.source:
+                continue
+            if self.banks[domain] is None:
+                self.banks[domain] = [layer.data.new_zeros(self.size, layer.size(1))
+                                      for layer in layers]
+            for bank, layer in zip(self.banks[domain], layers):
+                bank[index] = layer.data
+        self.pointer = (self.pointer + batch_size) % self.size
+        self.count = min(self.count + batch_size, self.size)
+
+    @staticmethod
+    def bank_jmmd(batch_list, bank_list, kernel_muls, kernel_nums, fix_sigma_list, full=False):
+        """Biased JMMD of batch against bank, without the constant bank-bank
+        term unless full."""
+        layer_num = len(batch_list)
+        bandwidths = [base_bandwidth(torch.cat([batch_list[i], bank_list[i]]), kernel_muls[i],
+                                     kernel_nums[i], fix_sigma_list[i])
+                      for i in range(layer_num)]
+        pairs = [(batch_list, batch_list, 1.), (batch_list, bank_list, -2.)]
+        if full:
+            pairs.append((bank_list, bank_list, 1.))
+        loss = 0
+        for x_list, y_list, sign in pairs:
+            distances = pairwise_distances(x_list, y_list)
+            loss = loss + sign * JointGaussianKernel.apply(
+                bandwidths, kernel_muls, kernel_nums, *distances).mean()
+        return loss
+
+    def __call__(self, source_list, target_list, kernel_muls, kernel_nums, fix_sigma_list):
+        layer_num = len(source_list)
+        params = (kernel_muls, kernel_nums, fix_sigma_list)
+        loss = 0
+        if self.count > 0:
+            # copies, since the queue is overwritten in place before backward
+            target_bank = [bank[:self.count].clone() for bank in self.banks['target']]
+            loss = loss + self.bank_jmmd(source_list, target_bank, *params)
+            if self.source:
+                source_bank = [bank[:self.count].clone() for bank in self.banks['source']]
+                loss = loss + self.bank_jmmd(target_list, source_bank, *params)
+        self.enqueue(source_list, target_list)
+        return self.weight * loss
+
+
+def feature_bank(args):
+    """Builds the JMMD memory bank selected by --mmd-bank."""
+    if args.mmd_bank > 0:
+        return FeatureBank(args.mmd_bank, source=args.mmd_bank_source,
+                           weight=args.mmd_bank_weight)
+    return None
+
+
+def layer_params(layer_num, kernel_muls, kernel_nums, fix_sigma_list):
+    """Pads each per-layer kernel setting list to layer_num layers. Extra taps
+    are inserted ahead of the last (output) layer and copy the first layer's
+    setting, without sharing a stateful BandwidthEstimator."""
+    def pad(values, default):
+        extra = layer_num - len(values)
+        if extra <= 0:
+            return values
+        return values[:1] + [default] * extra + values[1:]
+    fix_sigma = fix_sigma_list[0]
+    if isinstance(fix_sigma, BandwidthEstimator):
+        fix_sigma = None
+    return (pad(kernel_muls, kernel_muls[0]), pad(kernel_nums, kernel_nums[0]),
+            pad(fix_sigma_list, fix_sigma))
+
+
 def JMMDLoss(source_list, target_list, kernel_muls=[2.0, 2.0], 
              kernel_nums=[5, 1], fix_sigma_list=[None, 1.33],
-             b_test=False, graph_loss=0.):
-    knn = 3
+             b_test=False, graph_loss=0., linear='batched', backward='analytic',
+             knn=3, approx=None, memory_budget=None, bank=None, block=0):
+    if bank is not None:
+        bank_loss = bank(source_list, target_list, *layer_params(
+            len(source_list), kernel_muls, kernel_nums, fix_sigma_list))
+        return bank_loss + JMMDLoss(source_list, target_list, kernel_muls, kernel_nums,
+                                    fix_sigma_list, b_test, graph_loss, linear, backward,
+                                    knn, approx, memory_budget, block=block)
     batch_size = int(source_list[0].size()[0])
     layer_num = len(source_list)
-    joint_kernels = None
-    feature_kernel = None
-    output_distance = None
-    for i in range(layer_num):
-        source = source_list[i]
-        target = target_list[i]
-        kernel_mul = kernel_muls[i]
-        kernel_num = kernel_nums[i]
-        fix_sigma = fix_sigma_list[i]
-        kernels, distance = guassian_kernel(source, target,
-            kernel_mul=kernel_mul, kernel_num=kernel_num, fix_sigma=fix_sigma)
-        if joint_kernels is not None:
-            joint_kernels = joint_kernels * kernels
-            output_distance = distance
-        else:
-            joint_kernels = kernels
-            feature_kernel = kernels
+    kernel_muls, kernel_nums, fix_sigma_list = layer_params(
+        layer_num, kernel_muls, kernel_nums, fix_sigma_list)
+    totals = [torch.cat([source_list[i], target_list[i]]) for i in range(layer_num)]
     loss = 0
     if graph_loss > 0:
-        sorted, indices = torch.sort(feature_kernel, descending=True)
-        for i in range(batch_size):
-            for j in indices[i, :knn].data:
-                loss += feature_kernel[i, j] * output_distance[i, j]
-        loss = loss * graph_loss
+        feature_kernel, _ = guassian_kernel(source_list[0], target_list[0],
+            kernel_mul=kernel_muls[0], kernel_num=kernel_nums[0], fix_sigma=fix_sigma_list[0])
+        output_distance = pairwise_distance(totals[-1])
+        loss = graph_loss * knn_graph_loss(feature_kernel[:batch_size],
+                                           output_distance[:batch_size], knn)
+    if approx is not None:
+        # approx estimates the biased quadratic statistic, so scale as b_test does
+        return loss / float(batch_size)**2 + approx(source_list, target_list, kernel_muls, kernel_nums, fix_sigma_list)
+    if block:
+        return loss / float(batch_size) + block_jmmd(
+            source_list, target_list, block, kernel_muls, kernel_nums, fix_sigma_list)
+    if b_test and memory_budget:
+        tile = tile_size(memory_budget, layer_num, totals[0].element_size())
+        return loss / float(batch_size)**2 + TiledJMMDFunction.apply(
+            kernel_muls, kernel_nums, fix_sigma_list, tile, *totals)
+    if backward == 'analytic' and (b_test or linear == 'batched'):
+        loss = loss / (float(batch_size)**2 if b_test else float(batch_size))
+        return loss + JMMDFunction.apply(kernel_muls, kernel_nums, fix_sigma_list,
+                                         b_test, *totals)
+    distances = pairwise_distances(totals)
+    bandwidths = [base_bandwidth(totals[i], kernel_muls[i], kernel_nums[i], fix_sigma_list[i])
+                  for i in range(layer_num)]
+    joint_kernels = JointGaussianKernel.apply(bandwidths, kernel_muls, kernel_nums, *distances)
     if b_test:
         loss += joint_kernels[:batch_size, :batch_size].sum()
         loss += joint_kernels[batch_size:, batch_size:].sum()
@@ -80,14 +624,62 @@ def JMMDLoss(source_list, target_list, kernel_muls=[2.0, 2.0],
         loss -= joint_kernels[batch_size:, :batch_size].sum()
         return loss / float(batch_size)**2
     else:
-        for i in range(batch_size):
-            s1, s2 = i, (i+1)%batch_size
-            t1, t2 = s1+batch_size, s2+batch_size
-            loss += joint_kernels[s1, s2] + joint_kernels[t1, t2]
-            loss -= joint_kernels[s1, t2] + joint_kernels[s2, t1]
+        loss += LINEAR_ESTIMATORS[linear](joint_kernels, batch_size)
         return loss / float(batch_size)
 
 
+def subsample_rows(layers, max_samples=None):
+    """The same max_samples random rows of every layer (all rows if fewer)."""
+    n_samples = len(layers[0])
+    if not max_samples or n_samples <= max_samples:
+        return layers
+    layers = [torch.as_tensor(layer) for layer in layers]
+    index = torch.randperm(n_samples, device=layers[0].device)[:max_samples]
+    return [layer[index] for layer in layers]
+
+
+def jmmd_permutation_test(source_list, target_list, permutations=1000, kernel_muls=[2.0, 2.0],
+                          kernel_nums=[5, 1], fix_sigma_list=[None, 1.33], chunk=100,
+                          max_samples=None):
+    """Permutation two-sample test on the biased quadratic JMMD statistic.
+
+    Layers may be tensors or numpy arrays (e.g. the saved s_fc7/t_fc7), and
+    the two domains may have different sizes. The joint kernel K is built
+    once; each permutation is a row of a (P, N) weight matrix S with +1/n_s
+    on the samples relabelled as source and -1/n_t on the rest, so the null
+    statistics are the row sums of (S K) * S, taken chunk rows at a time.
+    K is dense, so each domain is first subsampled to at most max_samples
+    random rows. Returns (statistic, null distribution, p-value)."""
+    if not isinstance(source_list, (list, tuple)):
+        source_list, target_list = [source_list], [target_list]
+    source_list = subsample_rows(source_list, max_samples)
+    target_list = subsample_rows(target_list, max_samples)
+    layer_num = len(source_list)
+    kernel_muls, kernel_nums, fix_sigma_list = layer_params(
+        layer_num, kernel_muls, kernel_nums, fix_sigma_list)
+    with torch.no_grad():
+        totals = [torch.cat([torch.as_tensor(source_list[i]), torch.as_tensor(target_list[i])]).float()
+                  for i in range(layer_num)]
+        n_source, n_samples = len(source_list[0]), totals[0].size(0)
+        bandwidths = [base_bandwidth(totals[i], kernel_muls[i], kernel_nums[i], fix_sigma_list[i])
+                      for i in range(layer_num)]
+        log_joint, _ = joint_log_kernel(pairwise_distances(totals), bandwidths,
+                                        kernel_muls, kernel_nums)
+        joint = log_joint.exp_()
+        signs = joint.new_full((n_samples,), -1. / (n_samples - n_source))
+        signs[:n_source] = 1. / n_source
+        statistic = signs.dot(joint.mv(signs)).item()
+        null = []
+        for start in range(0, permutations, chunk):
+            rows = min(chunk, permutations - start)
+            order = torch.rand(rows, n_samples, device=joint.device).argsort(1)
+            weights = signs[order]
+            null.append((weights.mm(joint) * weights).sum(1))
+        null = torch.cat(null)
+    p_value = (1. + (null >= statistic).sum().item()) / (1. + permutations)
+    return statistic, null, p_value
+
+
 def CrossEntropyLoss(logits, target):
     loss = -logits * torch.log(torch.clamp(target.detach(), 0.001, 1))
     loss = torch.mean(torch.sum(loss, 1))
@@ -110,20 +702,54 @@ class RevLayer(torch.autograd.Function):
         return -1.*gradOutput
 
 
+def as_batch(x):
+    """Views 1-D inputs as a column of scalar samples."""
+    return x.view(x.size(0), -1)
+
+
+def linear_kernel(x, y):
+    return as_batch(x).mm(as_batch(y).t())
+
+
+def poly_kernel(x, y, degree=2, scale=1., coef0=0.):
+    return (scale * linear_kernel(x, y) + coef0) ** degree
+
+
+def fixed_gaussian_kernel(x, y, bandwidths=(.01, .02, .04)):
+    """Mean of exp(-|x - y|^2 / bw) over the bandwidths."""
+    distance = pairwise_distance(as_batch(x), as_batch(y))
+    return sum(torch.exp(-distance / bandwidth) for bandwidth in bandwidths) / float(len(bandwidths))
+
+
+def laplacian_kernel(x, y, bandwidth=1.):
+    distance = pairwise_distance(as_batch(x), as_batch(y))
+    # the sqrt has an infinite slope at 0, so keep the diagonal off it
+    return torch.exp(-torch.sqrt(distance + 1e-12) / bandwidth)
+
+
+def imq_kernel(x, y, c=1.):
+    """Inverse multiquadric c / sqrt(c^2 + |x - y|^2)."""
+    distance = pairwise_distance(as_batch(x), as_batch(y))
+    return c * torch.rsqrt(c ** 2 + distance)
+
+
+KERNELS = {
+    'linear': linear_kernel,
+    'poly': poly_kernel,
+    'gaussian': fixed_gaussian_kernel,
+    'laplacian': laplacian_kernel,
+    'imq': imq_kernel,
+}
+
+
+def kernel_mmd(source, target, kernel=fixed_gaussian_kernel):
+    """Biased quadratic MMD^2 of source and target under any KERNELS entry."""
+    return kernel(source, source).mean() + kernel(target, target).mean() - \
+           2 * kernel(source, target).mean()
+
+
 def Wasserstein_loss(source, target, source_l=None, target_l=None, kernel_type='gaussian'):
-    def kernel(s, t, type=kernel_type):
-        if type == 'linear':
-            s_ = s.unsqueeze(1).repeat(1, t.size()[0], 1)
-            t_ = t.unsqueeze(0).repeat(s.size()[0], 1, 1)
-            return torch.sum(torch.mul(s_, t_), 2).squeeze()
-        elif type == 'poly':
-            return torch.pow(torch.ger(s, t), 2)
-        elif type == 'gaussian':
-            ip = torch.ger(s.squeeze(), t.squeeze())
-            euclidean = torch.pow(s, 2).expand_as(ip) +\
-                        torch.pow(t, 2).expand_as(ip).t() -\
-                        2 * ip
-            return (torch.exp(-euclidean / .01) + torch.exp(-euclidean / .02) + torch.exp(-euclidean / .04))/3.
+    kernel = KERNELS[kernel_type]
     if source_l and target_l:
         # loss = kernel(source, source) * kernel(source_l, source_l, 'linear') +\
         #        kernel(target, target) * kernel(target_l, target_l, 'linear') -\
@@ -132,18 +758,40 @@ def Wasserstein_loss(source, target, source_l=None, target_l=None, kernel_type='
         rev = RevLayer()
         loss = JMMDLoss([source, rev(source_l)], [target, rev(target_l)])
     else:
-        ### loss = kernel(source, source) + kernel(target, target) - 2*kernel(source, target)
-        loss = MMDLoss(source, target)
+        loss = kernel_mmd(source, target, kernel)
     loss = -loss
 
     loss = torch.mean(loss)
     return loss
 
-def Domain_loss(source, target, source_l=None, target_l=None):
-    source_l = torch.autograd.Variable(torch.zeros(source.size()).cuda())
-    target_l = torch.autograd.Variable(torch.ones(target.size()).cuda())
-    output = torch.cat([source, target], 0)
-    label = torch.cat([source_l, target_l], 0)
+class DomainLoss(nn.Module):
+    """Binary domain classification loss for discriminator outputs, with
+    the source half labelled source_label and the target half the opposite.
 
-    loss = nn.BCELoss()(output, torch.autograd.Variable(torch.from_numpy(np.array([1] * 32 + [0] * 32)).float().cuda()))
-    return loss
+    Takes logits by default (fused sigmoid + BCE); logits=False takes
+    probabilities. The label tensor is built on the outputs' device once per
+    shape and reused, so the training loop allocates nothing on the host."""
+
+    def __init__(self, logits=True, source_label=1.):
+        super(DomainLoss, self).__init__()
+        self.logits = logits
+        self.source_label = source_label
+        self.labels = {}
+
+    def domain_labels(self, source, target):
+        key = (source.device, source.dtype, source.size(), target.size())
+        if key not in self.labels:
+            self.labels[key] = torch.cat([
+                torch.full_like(source, self.source_label),
+                torch.full_like(target, 1. - self.source_label)], 0)
+        return self.labels[key]
+
+    def forward(self, source, target):
+        output = torch.cat([source, target], 0)
+        label = self.domain_labels(source, target)
+        if self.logits:
+            return F.binary_cross_entropy_with_logits(output, label)
+        return F.binary_cross_entropy(output, label)
+
+
+Domain_loss = DomainLoss(logits=False)
@@ -16,7 +16,8 @@ from PIL import Image, ImageOps
 import numpy as np
 
 from utils import *
-from mysgd import SGD
+from mysgd import SGD, TorchSGD
+from data import *
 
 model_names = sorted(name for name in models.__dict__
     if name.islower() and not name.startswith("__")
@@ -57,6 +58,54 @@ parser.add_argument('--alpha', default=1., type=float, metavar='M',
                     help='mmd loss weight')
 parser.add_argument('--beta', default=.3, type=float, metavar='M',
                     help='cross entropy weight')
+parser.add_argument('--mmd-linear', default='batched', type=str,
+                    choices=['batched', 'loop'],
+                    help='linear-time (J)MMD estimator: one gather or per-sample loop')
+parser.add_argument('--jmmd-backward', default='analytic', type=str,
+                    choices=['analytic', 'autograd'],
+                    help='JMMD gradients: analytic autograd.Function or autograd graph')
+parser.add_argument('--knn', default=3, type=int, metavar='N',
+                    help='neighbours in the JMMD kNN graph regularizer (default: 3)')
+parser.add_argument('--mmd-approx', default='none', type=str,
+                    choices=['none', 'rff'],
+                    help='approximate (J)MMD: none (exact kernels) or random Fourier features; '
+                         'rff approximates the biased quadratic statistic, which is on a different '
+                         'scale from the default linear-time one, so retune the MMD loss weight')
+parser.add_argument('--rff-dim', default=1024, type=int, metavar='R',
+                    help='random Fourier features per bandwidth (default: 1024)')
+parser.add_argument('--rff-resample', default=1, type=int, metavar='N',
+                    help='redraw the Fourier projections every N iterations, 0 for never (default: 1)')
+parser.add_argument('--mmd-quadratic', dest='mmd_quadratic', action='store_true',
+                    help='use the biased quadratic JMMD statistic instead of the linear-time one')
+parser.add_argument('--mmd-memory-budget', default=0, type=float, metavar='MB',
+                    help='with --mmd-quadratic, tile the JMMD statistic to this many MB, '
+                         '0 for one block (default: 0)')
+parser.add_argument('--bandwidth', default='batch', type=str,
+                    choices=['batch', 'mean', 'median'],
+                    help='feature kernel bandwidth: recomputed per batch, or an EMA of the '
+                         'mean / subsampled median pairwise distance')
+parser.add_argument('--bandwidth-momentum', default=0.9, type=float, metavar='M',
+                    help='EMA momentum of the cached bandwidth (default: 0.9)')
+parser.add_argument('--bandwidth-every', default=10, type=int, metavar='N',
+                    help='refresh the cached bandwidth every N iterations (default: 10)')
+parser.add_argument('--mmd-bank', default=0, type=int, metavar='K',
+                    help='also match the source batch against the last K target activations (default: 0)')
+parser.add_argument('--mmd-bank-source', dest='mmd_bank_source', action='store_true',
+                    help='bank source activations too and match the target batch against them')
+parser.add_argument('--mmd-bank-weight', default=1., type=float, metavar='W',
+                    help='weight of the banked JMMD, a quadratic estimate on the b_test scale '
+                         '(default: 1)')
+parser.add_argument('--jmmd-pool5', dest='jmmd_pool5', action='store_true',
+                    help='add the backbone pool5 activations as an extra JMMD layer')
+parser.add_argument('--mmd-test', default=0, type=int, metavar='P',
+                    help='permutations for a JMMD two-sample test at each validation (default: 0, off)')
+parser.add_argument('--mmd-test-samples', default=2000, type=int, metavar='N',
+                    help='validation samples per domain drawn for the JMMD test (default: 2000)')
+parser.add_argument('--class-mmd', default=0., type=float, metavar='W',
+                    help='weight of the class-conditional MMD term in CAN (default: 0, off)')
+parser.add_argument('--mmd-block', default=0, type=int, metavar='b',
+                    help='unbiased block MMD estimator with blocks of b samples, '
+                         '2 (linear) to batch size (quadratic) (default: 0, off)')
 parser.add_argument('--gammaC', default=1., type=float, metavar='M',
                     help='C weight')
 parser.add_argument('--weight-decay', '--wd', default=5e-4, type=float,
@@ -67,6 +116,25 @@ parser.add_argument('--train-iter', default=50000, type=int,
                     metavar='N', help='')
 parser.add_argument('--test-iter', default=500, type=int,
                     metavar='N', help='')
+parser.add_argument('--image-cache', default='', type=str, metavar='DIR',
+                    help='serve each domain from a uint8 array of its 256x256 images, '
+                         'built under DIR on first use (default: decode every epoch)')
+parser.add_argument('--full-decode', dest='full_decode', action='store_true',
+                    help='decode JPEGs at full resolution instead of DCT-downscaling '
+                         'them to the smallest size covering 256x256')
+parser.add_argument('--decode-cache', default=0, type=float, metavar='MB',
+                    help='share decoded 256x256 images between all loaders and workers '
+                         'in an LRU cache of MB megabytes (default: 0, off)')
+parser.add_argument('--prefetch', default=2, type=int, metavar='N',
+                    help='training batches kept in flight to the GPU (default: 2)')
+parser.add_argument('--batch-augment', dest='batch_augment', action='store_true',
+                    help='load uint8 images and crop, flip and normalize whole batches '
+                         'on the training device')
+parser.add_argument('--freeze', default='', type=str, metavar='STAGE:ITER',
+                    help='freeze the backbone up to STAGE (e.g. layer3) until iteration ITER; '
+                         'comma-separate several to unfreeze gradually (default: none)')
+parser.add_argument('--flat-params', dest='flat_params', action='store_true',
+                    help='keep each parameter group in one contiguous optimizer buffer')
 parser.add_argument('--pretrained', dest='pretrained', action='store_true',
                     help='use pre-trained model')
 parser.add_argument('--fromcaffe', dest='fromcaffe', action='store_true',
@@ -90,9 +158,10 @@ def main():
     # define loss function (criterion) and optimizer
     criterion = nn.CrossEntropyLoss().cuda()
 
-    optimizer = torch.optim.SGD([i.copy() for i in args.SGD_param], args.lr,
-                                momentum=args.momentum,
-                                weight_decay=args.weight_decay)#,
+    optimizer = TorchSGD([i.copy() for i in args.SGD_param], args.lr,
+                         momentum=args.momentum,
+                         weight_decay=args.weight_decay,
+                         flat=args.flat_params)#,
     # nesterov=False)
 
     cudnn.benchmark = True
@@ -107,71 +176,54 @@ def main():
     # TODO: For debug
     normalize = transforms.Normalize([0.485, 0.456, 0.406],
                                      [0.229, 0.224, 0.225])
-
-    class MyScale(object):
-        def __init__(self, size, interpolation=Image.BILINEAR):
-            self.size = size
-            self.interpolation = interpolation
-
-        def __call__(self, img):
-            if isinstance(self.size, int):
-                w, h = img.size
-                if (w <= h and w == self.size) or (h <= w and h == self.size):
-                    return img
-                if w < h:
-                    ow = self.size
-                    oh = int(self.size * h / w)
-                    return img.resize((ow, oh), self.interpolation)
-                else:
-                    oh = self.size
-                    ow = int(self.size * w / h)
-                    return img.resize((ow, oh), self.interpolation)
-            else:
-                return img.resize(self.size)#, self.interpolation)
-
-    source_loader = torch.utils.data.DataLoader(
-        datasets.ImageFolder(traindir, transforms.Compose([
-            MyScale((256, 256)),
+    if args.batch_augment:
+        train_transform = val_transform = [to_uint8_tensor]
+    else:
+        train_transform = [
             transforms.RandomSizedCrop(224),
             transforms.RandomHorizontalFlip(),
             transforms.ToTensor(),
             normalize,
-        ])),
-        batch_size=args.batch_size, shuffle=True,
-        num_workers=args.workers, pin_memory=True)
-
-    target_loader = torch.utils.data.DataLoader(
-        datasets.ImageFolder(valdir, transforms.Compose([
-            MyScale((256, 256)),
-            transforms.RandomSizedCrop(224),
-            transforms.RandomHorizontalFlip(),
+        ]
+        val_transform = [
+            transforms.CenterCrop(224),
             transforms.ToTensor(),
             normalize,
-        ])),
-        batch_size=args.batch_size, shuffle=True,
-        num_workers=args.workers, pin_memory=True)
+        ]
+
+    loader = datasets.folder.default_loader if args.full_decode else None
+    decode_cache = None
+    if args.decode_cache:
+        decode_cache = DecodeCache([traindir, valdir], args.decode_cache * 2**20, loader=loader)
+
+    def domain(root, transform):
+        return image_folder(root, transform, args.image_cache,
+                            decode_cache=decode_cache, loader=loader)
+
+    train_loader = paired_loader(
+        domain(traindir, train_transform),
+        domain(valdir, train_transform),
+        args.batch_size, args.workers)
 
     val_loader = torch.utils.data.DataLoader(
-        datasets.ImageFolder(valdir, transforms.Compose([
-            MyScale((256, 256)),
-            transforms.CenterCrop(224),
-            transforms.ToTensor(),
-            normalize,
-        ])),
+        domain(valdir, val_transform),
         batch_size=4, shuffle=True,
         num_workers=args.workers, pin_memory=True)
     
     val_source_loader = torch.utils.data.DataLoader(
-        datasets.ImageFolder(traindir, transforms.Compose([
-            MyScale((256, 256)),
-            transforms.CenterCrop(224),
-            transforms.ToTensor(),
-            normalize,
-        ])),
+        domain(traindir, val_transform),
         batch_size=4, shuffle=True,
         num_workers=args.workers, pin_memory=True)
 
-    method.train_val(source_loader, target_loader, val_loader, val_source_loader,
+    if args.batch_augment:
+        device = 'cuda' if torch.cuda.is_available() else None
+        train_batch_transform = BatchTransform(224, train=True, device=device)
+        val_batch_transform = BatchTransform(224, train=False, device=device)
+        train_loader = BatchTransformLoader(train_loader, train_batch_transform)
+        val_loader = BatchTransformLoader(val_loader, val_batch_transform)
+        val_source_loader = BatchTransformLoader(val_source_loader, val_batch_transform)
+
+    method.train_val(train_loader, val_loader, val_source_loader,
                      model, criterion, optimizer, args)
 
 
@@ -19,6 +19,7 @@ import math
 
 from losses import *
 from utils import *
+from data import *
 
 ### Convert back-bone model
 class Net(nn.Module):
@@ -77,15 +78,18 @@ class Net(nn.Module):
         return y, x
 
 
-def train_val(source_loader, target_loader, val_loader, val_source_loader, model, criterion, optimizer, args):
+def train_val(train_loader, val_loader, val_source_loader, model, criterion, optimizer, args):
     batch_time = AverageMeter()
     data_time = AverageMeter()
     losses = AverageMeter()
     top1 = AverageMeter()
     entropy_loss = AverageMeter()
 
-    source_cycle = iter(source_loader)
-    target_cycle = iter(target_loader)
+    paired = DevicePrefetcher(train_loader, args.prefetch)
+    mmd_approx = mmd_approximation(args)
+    feature_bandwidth = bandwidth_estimator(args)
+    mmd_bank = feature_bank(args)
+    freezing = FreezeSchedule(model.origin_feature, args.freeze)
 
     end = time.time()
     model.train(True)
@@ -93,29 +97,31 @@ def train_val(source_loader, target_loader, val_loader, val_source_loader, model
         global global_iter
         global_iter = i
         adjust_learning_rate(optimizer, i, args)
+        freezing.step(optimizer, i)
         data_time.update(time.time() - end)
         
-        source_input, label = source_cycle.next()
-        target_input, _ = target_cycle.next()
-        if source_input.size()[0] < args.batch_size or target_input.size()[0] < args.batch_size:
-            source_cycle = iter(source_loader)
-            target_cycle = iter(target_loader)
-            source_input, label = source_cycle.next()
-            target_input, _ = target_cycle.next()
+        inputs, label, _ = next(paired)
             
-        label = label.cuda(async=True)
-        source_var = torch.autograd.Variable(source_input)
-        target_var = torch.autograd.Variable(target_input)
+        inputs = torch.autograd.Variable(inputs)
         label_var = torch.autograd.Variable(label)
 
-        inputs = torch.cat([source_var, target_var], 0)
         outputs, features = model(inputs)
         source_output, target_output = outputs.chunk(2, 0)
         source_feature, target_feature = features.chunk(2, 0)
+        if feature_bandwidth is not None:
+            feature_bandwidth.step(features)
         
         acc_loss = criterion(source_output, label_var)
         softmax = nn.Softmax()
-        jmmd_loss = JMMDLoss([source_feature, softmax(source_output)], [target_feature, softmax(target_output)])
+        jmmd_loss = JMMDLoss([source_feature, softmax(source_output)], [target_feature, softmax(target_output)],
+                             b_test=args.mmd_quadratic, linear=args.mmd_linear, backward=args.jmmd_backward,
+                             approx=mmd_approx, memory_budget=args.mmd_memory_budget, block=args.mmd_block,
+                             fix_sigma_list=[feature_bandwidth, 1.33], bank=mmd_bank)
+
+        if args.class_mmd > 0:
+            jmmd_loss = jmmd_loss + args.class_mmd * ClassMMDLoss(
+                source_feature, target_feature, label_var, softmax(target_output),
+                args.classes, fix_sigma=feature_bandwidth)
 
         loss = acc_loss + jmmd_loss
 
@@ -148,6 +154,11 @@ def train_val(source_loader, target_loader, val_loader, val_source_loader, model
         if i % args.test_iter == 0 and i != 0:
             t_fc7, t_fc8, t_label = validate(val_loader, model, criterion, args)
             s_fc7, s_fc8, s_label = validate(val_source_loader, model, criterion, args)
+            if args.mmd_test:
+                statistic, _, p_value = jmmd_permutation_test([s_fc7, s_fc8], [t_fc7, t_fc8],
+                                                              permutations=args.mmd_test,
+                                                              max_samples=args.mmd_test_samples)
+                print(' * JMMD {:.4f} p-value {:.4f}'.format(statistic, p_value))
             model.train(True)
             batch_time.reset()
             data_time.reset()
@@ -180,7 +191,7 @@ def validate(val_loader, model, criterion, args):
 
     end = time.time()
     for i, (input, target) in enumerate(val_loader):
-        target = target.cuda(async=True)
+        target = target.cuda(non_blocking=True)
         input_var = torch.autograd.Variable(input, volatile=True)
         target_var = torch.autograd.Variable(target, volatile=True)
 
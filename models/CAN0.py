@@ -21,6 +21,7 @@ import math
 
 from losses import *
 from utils import *
+from data import *
 
 
 class ResnetBlock(nn.Module):
@@ -208,13 +209,14 @@ def renormalize(input):
     return (input - new_mean) / new_std
 
 
-def train_val(source_loader, target_loader, val_loader, model, criterion, optimizer, args):
+def train_val(train_loader, val_loader, model, criterion, optimizer, args):
     batch_time = AverageMeter()
     data_time = AverageMeter()
     losses = AverageMeter()
     top1 = AverageMeter()
 
-    source_cycle = itertools.cycle(source_loader)
+    paired = DevicePrefetcher(train_loader, args.prefetch)
+    freezing = FreezeSchedule(model.origin_feature, args.freeze)
 
     end = time.time()
     netG_A = define_G(3, 3, 64, 'resnet_9blocks')
@@ -230,12 +232,10 @@ def train_val(source_loader, target_loader, val_loader, model, criterion, optimi
         global global_iter
         global_iter = i
         adjust_learning_rate(optimizer, i, args)
+        freezing.step(optimizer, i)
         data_time.update(time.time() - end)
-        source_input, label = source_cycle.next()
-        if source_input.size()[0] < args.batch_size:
-            source_input, label = source_cycle.next()
-        label = label.cuda(async=True)
-        source_var = torch.autograd.Variable(source_input).cuda()
+        inputs, label, _ = next(paired)
+        source_var = torch.autograd.Variable(inputs[:args.batch_size])
         label_var = torch.autograd.Variable(label)
 
         fake_target_var = netG_A(source_var)
@@ -286,7 +286,7 @@ def validate(val_loader, model, criterion, args):
 
     end = time.time()
     for i, (input, target) in enumerate(val_loader):
-        target = target.cuda(async=True)
+        target = target.cuda(non_blocking=True)
         input_var = torch.autograd.Variable(input, volatile=True).cuda()
         target_var = torch.autograd.Variable(target, volatile=True)
 
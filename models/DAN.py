@@ -19,6 +19,7 @@ import math
 
 from losses import *
 from utils import *
+from data import *
 
 global_iter = 0
 
@@ -81,15 +82,17 @@ class Net(nn.Module):
         return y, x
 
 
-def train_val(source_loader, target_loader, val_loader, model, criterion, optimizer, args):
+def train_val(train_loader, val_loader, model, criterion, optimizer, args):
     batch_time = AverageMeter()
     data_time = AverageMeter()
     losses = AverageMeter()
     top1 = AverageMeter()
     entropy_loss = AverageMeter()
 
-    source_cycle = itertools.cycle(source_loader)
-    target_cycle = itertools.cycle(target_loader)
+    paired = DevicePrefetcher(train_loader, args.prefetch)
+    mmd_approx = mmd_approximation(args)
+    feature_bandwidth = bandwidth_estimator(args)
+    freezing = FreezeSchedule(model.origin_feature, args.freeze)
 
     end = time.time()
     model.train()
@@ -97,23 +100,21 @@ def train_val(source_loader, target_loader, val_loader, model, criterion, optimi
         global global_iter
         global_iter = i
         adjust_learning_rate(optimizer, i, args)
+        freezing.step(optimizer, i)
         data_time.update(time.time() - end)
-        source_input, label = source_cycle.next()
-        if source_input.size()[0] < args.batch_size:
-            source_input, label = source_cycle.next()
-        target_input, _ = target_cycle.next()
-        if target_input.size()[0] < args.batch_size:
-            target_input, _ = target_cycle.next()
-        label = label.cuda(async=True)
-        source_var = torch.autograd.Variable(source_input)
-        target_var = torch.autograd.Variable(target_input)
+        inputs, label, _ = next(paired)
+        source_var, target_var = torch.autograd.Variable(inputs).chunk(2, 0)
         label_var = torch.autograd.Variable(label)
 
         source_output, source_feature = model(source_var)
         target_output, target_feature = model(target_var)
+        if feature_bandwidth is not None:
+            feature_bandwidth.step(torch.cat([source_feature, target_feature]))
 
         acc_loss = criterion(source_output, label_var)
-        mmd_loss = MMDLoss(source_feature, target_feature)
+        mmd_loss = MMDLoss(source_feature, target_feature, linear=args.mmd_linear,
+                           approx=mmd_approx, fix_sigma=feature_bandwidth,
+                           block=args.mmd_block)
         loss = acc_loss + args.alpha * \
                mmd_loss
         ###MMDLoss(source_output, target_output)+
@@ -165,7 +166,7 @@ def validate(val_loader, model, criterion, args):
 
     end = time.time()
     for i, (input, target) in enumerate(val_loader):
-        target = target.cuda(async=True)
+        target = target.cuda(non_blocking=True)
         input_var = torch.autograd.Variable(input, volatile=True)
         target_var = torch.autograd.Variable(target, volatile=True)
 
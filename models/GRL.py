@@ -19,6 +19,7 @@ import math
 
 from losses import *
 from utils import *
+from data import *
 
 global_iter = 0
 
@@ -72,7 +73,6 @@ class Net(nn.Module):
             nn.ReLU(),
             nn.Dropout(0.5),
             dc_ip3,
-            nn.Sigmoid(),
         )
         
         args.SGD_param = [
@@ -98,15 +98,16 @@ class Net(nn.Module):
         return y, x, dc7
 
 
-def train_val(source_loader, target_loader, val_loader, model, criterion, optimizer, args):
+def train_val(train_loader, val_loader, model, criterion, optimizer, args):
     batch_time = AverageMeter()
     data_time = AverageMeter()
     losses = AverageMeter()
     top1 = AverageMeter()
     entropy_loss = AverageMeter()
 
-    source_cycle = itertools.cycle(source_loader)
-    target_cycle = itertools.cycle(target_loader)
+    paired = DevicePrefetcher(train_loader, args.prefetch)
+    domain_loss = DomainLoss()
+    freezing = FreezeSchedule(model.origin_feature, args.freeze)
 
     end = time.time()
     model.train()
@@ -114,19 +115,12 @@ def train_val(source_loader, target_loader, val_loader, model, criterion, optimi
         global global_iter
         global_iter = i
         adjust_learning_rate(optimizer, i, args)
+        freezing.step(optimizer, i)
         data_time.update(time.time() - end)
-        source_input, label = source_cycle.next()
-        if source_input.size()[0] < args.batch_size:
-            source_input, label = source_cycle.next()
-        target_input, _ = target_cycle.next()
-        if target_input.size()[0] < args.batch_size:
-            target_input, _ = target_cycle.next()
-        label = label.cuda(async=True)
-        source_var = torch.autograd.Variable(source_input)
-        target_var = torch.autograd.Variable(target_input)
+        inputs, label, _ = next(paired)
+        inputs = torch.autograd.Variable(inputs)
         label_var = torch.autograd.Variable(label)
         
-        inputs = torch.cat([source_var, target_var], 0)
         outputs, features, dcs = model(inputs)
 
         source_output, target_output = outputs.chunk(2, 0)
@@ -134,7 +128,7 @@ def train_val(source_loader, target_loader, val_loader, model, criterion, optimi
         source_dc, target_dc = dcs.chunk(2, 0)
      
         acc_loss = criterion(source_output, label_var)
-        dc_loss = Domain_loss(source_dc, target_dc)
+        dc_loss = domain_loss(source_dc, target_dc)
             
         loss = acc_loss + args.alpha * dc_loss
 
@@ -185,7 +179,7 @@ def validate(val_loader, model, criterion, args):
 
     end = time.time()
     for i, (input, target) in enumerate(val_loader):
-        target = target.cuda(async=True)
+        target = target.cuda(non_blocking=True)
         input_var = torch.autograd.Variable(input, volatile=True)
         target_var = torch.autograd.Variable(target, volatile=True)
 
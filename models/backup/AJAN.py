@@ -114,7 +114,7 @@ def train_val(source_loader, target_loader, val_loader, model, criterion, optimi
             source_input, label = source_cycle.next()
             target_input, _ = target_cycle.next()
             
-        label = label.cuda(async=True)
+        label = label.cuda(non_blocking=True)
         source_var = torch.autograd.Variable(source_input)
         target_var = torch.autograd.Variable(target_input)
         label_var = torch.autograd.Variable(label)
@@ -177,7 +177,7 @@ def validate(val_loader, model, criterion, args):
 
     end = time.time()
     for i, (input, target) in enumerate(val_loader):
-        target = target.cuda(async=True)
+        target = target.cuda(non_blocking=True)
         input_var = torch.autograd.Variable(input, volatile=True)
         target_var = torch.autograd.Variable(target, volatile=True)
 
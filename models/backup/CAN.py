@@ -278,7 +278,7 @@ def train_val(source_loader, target_loader, val_loader, model, criterion, optimi
     end = time.time()
     model.eval()
     cycle_criterion = L2loss
-    discriminate_criterion = nn.BCELoss()
+    discriminate_criterion = DomainLoss(logits=False, source_label=0.)
     for i in range(args.train_iter):
         global global_iter
         global_iter = i
@@ -290,10 +290,7 @@ def train_val(source_loader, target_loader, val_loader, model, criterion, optimi
         target_input, _ = target_cycle.next()
         if target_input.size()[0] < args.batch_size:
             target_input, _ = target_cycle.next()
-        domain_label = torch.autograd.Variable(
-            torch.cat([torch.zeros(source_input.size()[0]),
-                       torch.ones(source_input.size()[0])], 0)).cuda()
-        label = label.cuda(async=True)
+        label = label.cuda(non_blocking=True)
         source_var = torch.autograd.Variable(source_input)
         target_var = torch.autograd.Variable(target_input)
         label_var = torch.autograd.Variable(label)
@@ -307,8 +304,8 @@ def train_val(source_loader, target_loader, val_loader, model, criterion, optimi
             + criterion(fake_output_t, label_var)
         cycle_loss = cycle_criterion(feature_s, cycle_s) \
             + cycle_criterion(feature_t, cycle_t)
-        discriminate_loss = discriminate_criterion(discriminate_s, domain_label) \
-            + discriminate_criterion(discriminate_t, domain_label)
+        discriminate_loss = discriminate_criterion(*discriminate_s.chunk(2, 0)) \
+            + discriminate_criterion(*discriminate_t.chunk(2, 0))
 
         loss = acc_loss + args.alpha * cycle_loss + args.beta * discriminate_loss
         # loss = discriminate_loss
@@ -359,7 +356,7 @@ def validate(val_loader, model, criterion, args):
 
     end = time.time()
     for i, (input, target) in enumerate(val_loader):
-        target = target.cuda(async=True)
+        target = target.cuda(non_blocking=True)
         input_var = torch.autograd.Variable(input, volatile=True)
         target_var = torch.autograd.Variable(target, volatile=True)
 
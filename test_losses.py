@@ -0,0 +1,217 @@
+import torch
+
+from losses import *
+
+
+def features(*sizes):
+    torch.manual_seed(0)
+    return [torch.randn(size, dtype=torch.float64, requires_grad=True) for size in sizes]
+
+
+def value_and_grads(loss_fn, inputs):
+    loss = loss_fn()
+    grads = torch.autograd.grad(loss, inputs)
+    return loss.detach(), grads
+
+
+def assert_close(first, second):
+    (loss1, grads1), (loss2, grads2) = first, second
+    assert torch.allclose(loss1, loss2)
+    for grad1, grad2 in zip(grads1, grads2):
+        assert torch.allclose(grad1, grad2)
+
+
+def test_mmd_linear_batched_matches_loop():
+    source, target = features((16, 8), (16, 8))
+    assert_close(
+        value_and_grads(lambda: MMDLoss(source, target, linear='batched'), [source, target]),
+        value_and_grads(lambda: MMDLoss(source, target, linear='loop'), [source, target]))
+
+
+def test_jmmd_linear_batched_matches_loop():
+    source_feature, target_feature, source_output, target_output = features(
+        (16, 8), (16, 8), (16, 4), (16, 4))
+    inputs = [source_feature, target_feature, source_output, target_output]
+    for backward in ('analytic', 'autograd'):
+        assert_close(
+            value_and_grads(lambda: JMMDLoss([source_feature, source_output],
+                                             [target_feature, target_output],
+                                             linear='batched', backward=backward), inputs),
+            value_and_grads(lambda: JMMDLoss([source_feature, source_output],
+                                             [target_feature, target_output],
+                                             linear='loop'), inputs))
+
+
+def test_jmmd_function_gradcheck():
+    totals = features((16, 8), (16, 4))
+    for b_test in (False, True):
+        assert torch.autograd.gradcheck(
+            lambda *totals: JMMDFunction.apply([2.0, 2.0], [5, 1], [1., 1.33], b_test, *totals),
+            totals)
+
+
+def test_jmmd_analytic_matches_autograd():
+    source_feature, target_feature, source_output, target_output = features(
+        (16, 8), (16, 8), (16, 4), (16, 4))
+    inputs = [source_feature, target_feature, source_output, target_output]
+    for b_test in (False, True):
+        assert_close(
+            value_and_grads(lambda: JMMDLoss([source_feature, source_output],
+                                             [target_feature, target_output],
+                                             b_test=b_test, backward='analytic'), inputs),
+            value_and_grads(lambda: JMMDLoss([source_feature, source_output],
+                                             [target_feature, target_output],
+                                             b_test=b_test, backward='autograd'), inputs))
+
+
+def test_tiled_jmmd_function_gradcheck():
+    totals = features((16, 8), (16, 4))
+    assert torch.autograd.gradcheck(
+        lambda *totals: TiledJMMDFunction.apply([2.0, 2.0], [5, 1], [1., 1.33], 5, *totals),
+        totals)
+
+
+def test_tiled_jmmd_matches_quadratic():
+    source_feature, target_feature, source_output, target_output = features(
+        (16, 8), (16, 8), (16, 4), (16, 4))
+    inputs = [source_feature, target_feature, source_output, target_output]
+    assert_close(
+        value_and_grads(lambda: JMMDLoss([source_feature, source_output],
+                                         [target_feature, target_output],
+                                         b_test=True, memory_budget=1e-4), inputs),
+        value_and_grads(lambda: JMMDLoss([source_feature, source_output],
+                                         [target_feature, target_output],
+                                         b_test=True), inputs))
+
+
+def test_bandwidth_estimator_updates_once_per_step():
+    source_feature, target_feature, source_output, target_output = features(
+        (16, 8), (16, 8), (16, 4), (16, 4))
+    estimator = BandwidthEstimator(momentum=0.5, update_every=2)
+    bank = FeatureBank(32, source=True)
+    bandwidths = []
+    for _ in range(3):
+        estimator.step(torch.cat([source_feature, target_feature]))
+        JMMDLoss([source_feature, source_output], [target_feature, target_output],
+                 graph_loss=1., fix_sigma_list=[estimator, 1.33], bank=bank)
+        bandwidths.append(estimator.bandwidth)
+    assert estimator.steps == 3
+    assert bandwidths[0] is bandwidths[1] and bandwidths[1] is not bandwidths[2]
+
+
+def test_layer_params_pads_each_list():
+    estimator = BandwidthEstimator()
+    kernel_muls, kernel_nums, fix_sigma_list = layer_params(
+        3, [2.0, 2.0], [5, 1], [None, estimator, 1.33])
+    assert kernel_muls == [2.0, 2.0, 2.0]
+    assert kernel_nums == [5, 5, 1]
+    assert fix_sigma_list == [None, estimator, 1.33]
+    kernel_muls, kernel_nums, fix_sigma_list = layer_params(
+        3, [2.0, 2.0], [5, 1], [estimator, 1.33])
+    assert kernel_nums == [5, 5, 1]
+    assert fix_sigma_list == [estimator, None, 1.33]
+
+
+def explicit_gaussian_kernel(source, target, kernel_mul, kernel_num, fix_sigma):
+    total = torch.cat([source, target])
+    distance = ((total.unsqueeze(0) - total.unsqueeze(1)) ** 2).sum(2)
+    bandwidth = fix_sigma / kernel_mul ** (kernel_num // 2)
+    return sum(torch.exp(-distance / (bandwidth * kernel_mul ** i)) for i in range(kernel_num))
+
+
+def test_fused_kernel_matches_exp_sum():
+    for scale in (1., 10.):
+        source, target = features((16, 8), (16, 8))
+        with torch.no_grad():
+            source *= scale
+            target *= scale
+        for kernel_mul in (2.0, 1.5):
+            for fix_sigma in (16., 1.):
+                weights = torch.randn(32, 32, dtype=torch.float64)
+                fused = lambda: (guassian_kernel(source, target, kernel_mul, 5, fix_sigma)[0]
+                                 * weights).sum()
+                explicit = lambda: (explicit_gaussian_kernel(source, target, kernel_mul, 5, fix_sigma)
+                                    * weights).sum()
+                assert_close(value_and_grads(fused, [source, target]),
+                             value_and_grads(explicit, [source, target]))
+
+
+def knn_graph_loss_loop(feature_kernel, output_distance, batch_size, knn=3):
+    """The original regularizer: source rows times their knn sorted neighbours."""
+    loss = 0
+    _, indices = torch.sort(feature_kernel, descending=True)
+    for i in range(batch_size):
+        for j in indices[i, :knn].data:
+            loss += feature_kernel[i, j] * output_distance[i, j]
+    return loss
+
+
+def test_jmmd_graph_loss_matches_loop():
+    source_feature, target_feature, source_output, target_output = features(
+        (16, 8), (16, 8), (16, 4), (16, 4))
+    inputs = [source_feature, target_feature, source_output, target_output]
+
+    def loop_loss(knn):
+        feature_kernel, _ = guassian_kernel(source_feature, target_feature)
+        _, output_distance = guassian_kernel(source_output, target_output, 2.0, 1, 1.33)
+        graph = knn_graph_loss_loop(feature_kernel, output_distance, 16, knn)
+        return 0.5 * graph / 16. + JMMDLoss([source_feature, source_output],
+                                            [target_feature, target_output])
+
+    for knn in (1, 3):
+        assert_close(
+            value_and_grads(lambda: JMMDLoss([source_feature, source_output],
+                                             [target_feature, target_output],
+                                             graph_loss=0.5, knn=knn), inputs),
+            value_and_grads(lambda: loop_loss(knn), inputs))
+
+
+def test_bank_jmmd_matches_quadratic_jmmd():
+    batch_feature, bank_feature, batch_output, bank_output = features(
+        (8, 6), (24, 6), (8, 3), (24, 3))
+    bank_feature, bank_output = bank_feature.detach(), bank_output.detach()
+    params = ([2.0, 2.0], [5, 1], [4., 1.33])
+
+    def explicit():
+        total = [torch.cat([batch_feature, bank_feature]), torch.cat([batch_output, bank_output])]
+        joint = explicit_gaussian_kernel(batch_feature, bank_feature, 2.0, 5, 4.) * \
+                explicit_gaussian_kernel(batch_output, bank_output, 2.0, 1, 1.33)
+        signs = torch.cat([torch.full((8,), 1. / 8, dtype=torch.float64),
+                           torch.full((24,), -1. / 24, dtype=torch.float64)])
+        return signs.dot(joint.mv(signs))
+
+    inputs = [batch_feature, batch_output]
+    full = lambda: FeatureBank.bank_jmmd([batch_feature, batch_output], [bank_feature, bank_output],
+                                         *params, full=True)
+    assert_close(value_and_grads(full, inputs), value_and_grads(explicit, inputs))
+    _, grads = value_and_grads(lambda: FeatureBank.bank_jmmd(
+        [batch_feature, batch_output], [bank_feature, bank_output], *params), inputs)
+    _, full_grads = value_and_grads(full, inputs)
+    for grad, full_grad in zip(grads, full_grads):
+        assert torch.allclose(grad, full_grad)
+
+
+def test_permutation_test_p_values():
+    torch.manual_seed(0)
+    source = [torch.randn(60, 8), torch.softmax(torch.randn(60, 4), 1)]
+    shifted = [torch.randn(60, 8) + 1., torch.softmax(torch.randn(60, 4), 1)]
+    _, null, p_value = jmmd_permutation_test(source, shifted, permutations=200)
+    assert null.size() == (200,)
+    assert p_value < 0.01
+
+    p_values = []
+    for _ in range(60):
+        source = [torch.randn(60, 8), torch.softmax(torch.randn(60, 4), 1)]
+        target = [torch.randn(60, 8), torch.softmax(torch.randn(60, 4), 1)]
+        p_values.append(jmmd_permutation_test(source, target, permutations=100)[2])
+    p_values = torch.tensor(p_values)
+    assert 0.3 < p_values.mean() < 0.7
+    assert (p_values < 0.05).float().mean() < 0.2
+
+
+def test_permutation_test_subsamples():
+    torch.manual_seed(0)
+    source = [np.random.randn(500, 8), np.random.randn(500, 4)]
+    target = [np.random.randn(300, 8) + 1., np.random.randn(300, 4)]
+    statistic, _, p_value = jmmd_permutation_test(source, target, permutations=50, max_samples=100)
+    assert statistic > 0 and p_value < 0.05
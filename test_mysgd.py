@@ -0,0 +1,76 @@
+import io
+
+import torch
+
+from mysgd import SGD, TorchSGD
+
+SHAPES = [(5, 3), (3,), (4, 4, 2)]
+
+
+def make_params():
+    torch.manual_seed(0)
+    return [torch.randn(shape, dtype=torch.float64, requires_grad=True) for shape in SHAPES]
+
+
+def set_grads(params, step, late=None):
+    """Deterministic per-step gradients; params[late] gets none before step 2."""
+    for i, p in enumerate(params):
+        if i == late and step < 2:
+            if p.grad is not None:
+                p.grad.data.zero_()
+            continue
+        generator = torch.Generator().manual_seed(100 * step + i)
+        grad = torch.randn(p.size(), dtype=p.dtype, generator=generator)
+        if p.grad is None:
+            p.grad = grad
+        else:
+            p.grad.data.copy_(grad)
+
+
+def run(optimizer_class, steps=5, late=None, **options):
+    params = make_params()
+    optimizer = optimizer_class(params, **options)
+    for step in range(steps):
+        set_grads(params, step, late)
+        optimizer.step()
+    return params, optimizer
+
+
+def test_foreach_matches_loop():
+    for options in (dict(lr=0.1, momentum=0.9),
+                    dict(lr=0.1, momentum=0.9, weight_decay=5e-4),
+                    dict(lr=0.1, momentum=0.9, weight_decay=5e-4, nesterov=True),
+                    dict(lr=0.1, momentum=0.9, dampening=0.5),
+                    dict(lr=0.1, weight_decay=5e-4)):
+        loop, loop_optimizer = run(SGD, late=1, **options)
+        foreach, foreach_optimizer = run(SGD, late=1, foreach=True, **options)
+        for p, q in zip(loop, foreach):
+            assert torch.allclose(p, q)
+            if options.get('momentum'):
+                assert torch.allclose(loop_optimizer.state[p]['momentum_buffer'],
+                                      foreach_optimizer.state[q]['momentum_buffer'])
+
+
+def test_state_dict_round_trip():
+    options = dict(lr=0.1, momentum=0.9)
+    for optimizer_class in (SGD, TorchSGD):
+        for flat_first in (False, True):
+            params, optimizer = run(optimizer_class, steps=2, late=1, flat=flat_first, **options)
+            checkpoint = io.BytesIO()
+            torch.save(optimizer.state_dict(), checkpoint)
+            checkpoint.seek(0)
+            state_dict = torch.load(checkpoint)
+            copies = [p.detach().clone().requires_grad_() for p in params]
+            loaded = optimizer_class(copies, flat=not flat_first, **options)
+            loaded.load_state_dict(state_dict)
+            for step in (2, 3):
+                for group in (params, copies):
+                    set_grads(group, step, late=1)
+                optimizer.step()
+                loaded.step()
+            for p, q in zip(params, copies):
+                assert torch.allclose(p, q)
+            states, loaded_states = optimizer.state_dict()['state'], loaded.state_dict()['state']
+            for j in range(len(params)):
+                assert torch.allclose(states[j]['momentum_buffer'],
+                                      loaded_states[j]['momentum_buffer'])
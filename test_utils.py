@@ -0,0 +1,39 @@
+import torch
+import torch.nn as nn
+
+from utils import FreezeSchedule
+
+
+def make_model():
+    torch.manual_seed(0)
+    return nn.Sequential(nn.Linear(4, 4), nn.BatchNorm1d(4), nn.Linear(4, 2))
+
+
+def bn_training(model):
+    return model[1].training
+
+
+def test_freeze_schedule():
+    for training in (True, False):
+        model = make_model()
+        params = list(model.parameters())
+        optimizer = torch.optim.SGD([{'params': params[:2]}, {'params': params[2:]}],
+                                    lr=0.1, momentum=0.9)
+        freezing = FreezeSchedule(model, '1:5')
+        model.train(training)
+        for i in range(5):
+            freezing.step(optimizer, i)
+            assert [p.requires_grad for p in params] == [False] * 4 + [True] * 2
+            assert optimizer.param_groups[0]['params'] == []
+            assert optimizer.param_groups[1]['params'] == params[4:]
+            assert not bn_training(model)
+            model(torch.randn(8, 4)).sum().backward()
+            optimizer.step()
+            assert all(p.grad is None for p in params[:4])
+            model.train(training)
+
+        freezing.step(optimizer, 5)
+        assert all(p.requires_grad for p in params)
+        assert optimizer.param_groups[0]['params'] == params[:2]
+        assert optimizer.param_groups[1]['params'] == params[2:]
+        assert bn_training(model) == training
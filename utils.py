@@ -47,6 +47,69 @@ def adjust_learning_rate(optimizer, iter_num, args):
         param_group['lr'] = lr * args.SGD_param[i]['lr']
 
 
+RESNET_STAGES = ['conv1', 'bn1', 'relu', 'maxpool', 'layer1', 'layer2', 'layer3', 'layer4', 'avgpool']
+
+
+class FreezeSchedule(object):
+    """Freezes a prefix of the backbone's stages early in training.
+
+    spec is 'stage:iter[,stage:iter...]': the backbone is frozen up to and
+    including `stage` while the iteration is below `iter`, e.g. 'layer3:2000'.
+    Stages are backbone children, by name (resnet names also work for the
+    unnamed nn.Sequential backbones) or index. Frozen parameters get
+    requires_grad=False and are dropped from the optimizer, and their
+    BatchNorm layers run in eval mode. As neither the input nor any frozen
+    parameter requires grad, autograd records nothing for the frozen prefix:
+    it runs as under no_grad, keeping no activations and costing no backward."""
+
+    def __init__(self, backbone, spec):
+        backbone = getattr(backbone, 'module', backbone)
+        self.backbone = backbone
+        self.stages = list(backbone.children())
+        names = [name for name, _ in backbone.named_children()]
+        if len(names) == len(RESNET_STAGES) and all(name.isdigit() for name in names):
+            names = RESNET_STAGES
+        self.schedule = []
+        for item in spec.split(','):
+            if not item:
+                continue
+            stage, until = item.split(':')
+            index = names.index(stage) if stage in names else int(stage)
+            self.schedule.append((index + 1, int(until)))
+        self.frozen = 0
+        self.groups = None
+
+    def step(self, optimizer, iter_num):
+        """Applies the schedule at iteration iter_num; call it every iteration
+        since model.train() puts frozen BatchNorm layers back in train mode."""
+        frozen = max([stages for stages, until in self.schedule if iter_num < until] or [0])
+        if frozen != self.frozen:
+            self.freeze(optimizer, frozen)
+        for stage in self.stages[:frozen]:
+            for module in stage.modules():
+                if isinstance(module, nn.modules.batchnorm._BatchNorm):
+                    module.eval()
+
+    def freeze(self, optimizer, frozen):
+        if getattr(optimizer, 'flat_groups', None) is not None:
+            raise ValueError("layer freezing needs an optimizer without flat parameters")
+        if self.groups is None:
+            self.groups = [list(group['params']) for group in optimizer.param_groups]
+        frozen_params = set()
+        for i, stage in enumerate(self.stages):
+            for p in stage.parameters():
+                p.requires_grad = i >= frozen
+                if i < frozen:
+                    frozen_params.add(p)
+                    p.grad = None
+                    optimizer.state.pop(p, None)
+            if frozen <= i < self.frozen:
+                stage.train(self.backbone.training)
+        for group, params in zip(optimizer.param_groups, self.groups):
+            group['params'] = [p for p in params if p not in frozen_params]
+        self.frozen = frozen
+
+
 def accuracy(output, target, topk=(1,)):
     """Computes the precision@k for the specified values of k"""
     maxk = max(topk)